@@ -1 +1,3 @@
-__import__("pkg_resources").declare_namespace(__name__)
+# a pkgutil-style namespace package, which unlike a pkg_resources-style one doesn't import pkg_resources, whose
+# import takes longer than the rest of docopt-completion's startup
+__path__ = __import__("pkgutil").extend_path(__path__, __name__)
@@ -1 +0,0 @@
-__import__("pkg_resources").declare_namespace(__name__)
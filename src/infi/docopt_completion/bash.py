@@ -1,8 +1,11 @@
-from .common import CompletionGenerator
+from .common import CompletionGenerator, HelpIndex, SharedSubtrees, SharedFragments, group_by_function
 import os
 import string
 
-FILE_TEMPLATE = """{0}\ncomplete -o bashdefault -o default -o filenames -F _{1} {2}"""
+# the sections are streamed before the end of the file
+FILE_END_TEMPLATE = """\ncomplete -o bashdefault -o default -o filenames -F _{1} {2}"""
+
+FILE_TEMPLATE = "{0}" + FILE_END_TEMPLATE
 
 SECTION_TEMPLATE = """
 _{cmd_name}()
@@ -11,7 +14,7 @@ _{cmd_name}()
     cur="${{COMP_WORDS[COMP_CWORD]}}"
 
     if [ $COMP_CWORD -{op} {level_num} ]; then
-        COMPREPLY=( $( compgen {compreply} -- $cur) ){subcommand_switch}
+        COMPREPLY=( $( compgen {compreply} -- $cur) ){values}{describe}{subcommand_switch}
     fi
 }}
 """
@@ -27,7 +30,163 @@ CASE_TEMPLATE = """            {0})
             _{1}_{0}
         ;;"""
 
+# In shared fragments mode, subcommands whose sections would be identical (apart from their names) share the section
+# of the first one, and a single case calls the shared function for all of them. Word lists used by several sections
+# are defined once, in a variable.
+SHARED_CASE_TEMPLATE = """            {0})
+            _{1}
+        ;;"""
+
+SHARED_WORDS_TEMPLATE = """
+_{0}='{1}'
+"""
+
+SHARED_WORDS_REFERENCE = '"$_{0}"'
+
+MIN_SHARED_WORDS_LENGTH = 24
+
+# The flat mode replaces the function-per-subcommand sections with lookup tables (associative arrays keyed by the
+# subcommand path, starting with the command name), so completing a word is a walk over the typed subcommands,
+# a single table lookup and prefix filtering done by bash itself, without running compgen in a subshell.
+# _{name}_words holds the word list of each path, _{name}_files marks the paths with arguments (where files are
+# suggested as well, unless an option is being typed) and _{name}_leaves marks the paths without subcommands,
+# after which any number of words may be typed.
+# "declare -g" is needed because bash-completion may source this file from inside a function.
+FLAT_TABLES = ["words", "files", "leaves"]
+
+FLAT_TABLE_START_TEMPLATE = """declare -gA _{name}_{table}=(
+"""
+
+FLAT_TABLE_END = """
+)
+"""
+
+FLAT_FUNCTION_TEMPLATE = """
+_{name}()
+{{
+    local cur path word i
+    cur="${{COMP_WORDS[COMP_CWORD]}}"
+    path="{name}"
+
+    for (( i=1; i < COMP_CWORD; i++ )); do
+        [[ -n ${{_{name}_leaves[$path]}} ]] && break
+        path="$path ${{COMP_WORDS[i]}}"
+        [[ -n ${{_{name}_words[$path]+x}} ]] || return 0
+    done
+    COMPREPLY=()
+    if [[ -n ${{_{name}_files[$path]}} && $cur != -* ]]; then
+        COMPREPLY=( $( compgen -f -- $cur) )
+    fi
+    for word in ${{_{name}_words[$path]}}; do
+        [[ $word == "$cur"* ]] && COMPREPLY+=( "$word" )
+    done{values}{describe}
+}}
+complete -o bashdefault -o default -o filenames -F _{name} {cmd}"""
+
+FLAT_ENTRY_TEMPLATE = """    ["{0}"]='{1}'"""
+
+# In descriptions mode, when several words are suggested, they are listed with their descriptions.
+# The display strings are precomputed, with the descriptions aligned, in the _{name}_descriptions table, keyed by the
+# subcommand path (as in the flat mode tables) and the word. A single suggestion is left as is, since bash inserts it
+# into the command line. Words without a description, such as file names, are listed as they are.
+DESCRIBE_TEMPLATE = """
+declare -gA _{name}_descriptions
+
+_{name}_describe()
+{{
+    local i key
+    (( ${{#COMPREPLY[@]}} > 1 )) || return 0
+    for i in "${{!COMPREPLY[@]}}"; do
+        key="$1 ${{COMPREPLY[i]}}"
+        [[ -n ${{_{name}_descriptions[$key]+x}} ]] && COMPREPLY[i]="${{_{name}_descriptions[$key]}}"
+    done
+}}
+"""
+
+DESCRIPTIONS_START_TEMPLATE = """_{name}_descriptions+=(
+"""
+
+SECTION_DESCRIBE_TEMPLATE = '''
+        _{0}_describe "{1}"'''
+
+FLAT_DESCRIBE_TEMPLATE = '''
+    _{0}_describe "$path"'''
+
+DESCRIPTION_DISPLAY_TEMPLATE = "{0}  -- {1}"
+
+# In dynamic values mode, the values of the argument being completed are asked from the completion daemon
+# (see daemon.py) over its Unix socket, with socat or nc, and added to the suggestions.
+# _{name}_values gets the subcommand path, the index of the first word after it and the names of its arguments,
+# and finds the argument being completed by counting the words that aren't options.
+# Nothing is added if the daemon isn't running or neither socat nor nc are installed.
+VALUES_TEMPLATE = """
+_docopt_completion_query()
+{{
+    if type -P socat >/dev/null; then
+        socat -t 1 - "UNIX-CONNECT:$1" 2>/dev/null
+    elif type -P nc >/dev/null; then
+        nc -U -w 1 "$1" 2>/dev/null
+    fi
+}}
+
+_{name}_values()
+{{
+    local path="$1" level=$2 cur="${{COMP_WORDS[COMP_CWORD]}}" argcount=0 i sock value
+    shift 2
+    [[ $cur == -* ]] && return 0
+    for (( i=level; i < COMP_CWORD; i++ )); do
+        [[ ${{COMP_WORDS[i]}} == -* ]] || (( argcount++ ))
+    done
+    (( argcount < $# )) || return 0
+    shift $argcount
+    if [[ -n $DOCOPT_COMPLETION_SOCKET ]]; then
+        sock=$DOCOPT_COMPLETION_SOCKET
+    elif [[ -n $XDG_RUNTIME_DIR ]]; then
+        sock=$XDG_RUNTIME_DIR/docopt-completion.sock
+    else
+        sock=/tmp/docopt-completion-$UID.sock
+    fi
+    [[ -S $sock ]] || return 0
+    while IFS= read -r value; do
+        COMPREPLY+=( "$value" )
+    done < <(printf '%s\\t%s\\t%s\\t%s\\n' '{cmd}' "$path" "$1" "$cur" | _docopt_completion_query "$sock")
+}}
+"""
+
+SECTION_VALUES_TEMPLATE = """
+        _{0}_values '{1}' {2} {3}"""
+
+FLAT_VALUES_TEMPLATE = """
+    [[ -n ${{_{name}_arguments[$path]}} ]] && _{name}_values "${{path#{name}}}" $i ${{_{name}_arguments[$path]}}"""
+
+# In split mode, the sections of every top-level subcommand are written to a separate file in the "<cmd>.d"
+# directory next to the completion file. The completion file defines a stub function for each of them, which sources
+# the file (redefining the function) the first time the subcommand is completed.
+# The directory is found relative to the completion file, so the files can be moved together
+PARTS_DIR_TEMPLATE = """
+_{name}_parts_dir="${{BASH_SOURCE[0]%/*}}"
+[[ $_{name}_parts_dir == "${{BASH_SOURCE[0]}}" ]] && _{name}_parts_dir=.
+_{name}_parts_dir="$_{name}_parts_dir/{parts_dir}"
+"""
+
+STUB_SECTION_TEMPLATE = """
+_{name}_{subcommand}()
+{{
+    . "$_{name}_parts_dir/{subcommand}" && _{name}_{subcommand}
+}}
+"""
+
 class BashCompletion(CompletionGenerator):
+    def __init__(self, flat=False, descriptions=False, dynamic_values=False, share_fragments=False):
+        # flat: generate lookup tables instead of a function per subcommand. requires bash 4.2
+        # descriptions: list the suggested options and subcommands with their descriptions. requires bash 4.2
+        # dynamic_values: complete argument values from the completion daemon, when it is running
+        # share_fragments: emit identical sections and word lists once. not used in flat mode
+        self.flat = flat
+        self.descriptions = descriptions
+        self.dynamic_values = dynamic_values
+        self.share_fragments = share_fragments
+
     def get_name(self):
         return "BASH with bash-completion"
 
@@ -38,45 +197,265 @@ class BashCompletion(CompletionGenerator):
         completion_path = self.get_completion_path()
         return os.path.join(completion_path, "{0}.sh".format(cmd))
 
-    def create_subcommand_switch(self, cmd_name, level_num, subcommands, opts):
+    def create_subcommand_switch(self, cmd_name, level_num, subcommands, opts, functions=None):
+        # functions maps the subcommands to the names of their functions, if they aren't the default ones
         if len(subcommands) == 0:
             return ""
-        subcommand_cases = '\n'.join(CASE_TEMPLATE.format(subcommand, cmd_name) for subcommand in subcommands)
+        if functions is None:
+            subcommand_cases = '\n'.join(CASE_TEMPLATE.format(subcommand, cmd_name) for subcommand in subcommands)
+        else:
+            subcommand_cases = '\n'.join(SHARED_CASE_TEMPLATE.format("|".join(group), function)
+                                         for function, group in group_by_function(subcommands, functions))
         return SUBCOMMAND_SWITCH_TEMPLATE.format(level_num=level_num, subcommand_cases=subcommand_cases)
 
-    def create_compreply(self, param_tree):
+    def create_compreply(self, param_tree, word_list=None):
         # add -f (show files in completion options) if there are arguments in the current section
         # in this case there are (usually) no subcommands to suggest, and only flags, so it's ok to suggest files,
         # and if the user types "-" first, then only the flags will be suggested
+        # word_list is the quoted word list argument, if it isn't the literal word list
         flag = '-fW' if len(param_tree.arguments) > 0 else '-W'
-        word_list = " ".join(param_tree.options) + " " + " ".join(param_tree.subcommands.keys())
-        return "{} '{}'".format(flag, word_list)
+        if word_list is None:
+            word_list = "'{}'".format(self.create_word_list(param_tree))
+        return "{} {}".format(flag, word_list)
 
-    def create_section(self, cmd_name, param_tree, option_help, level_num):
+    def create_word_list(self, param_tree):
+        return " ".join(param_tree.options) + " " + " ".join(param_tree.subcommands.keys())
+
+    def create_single_section(self, cmd_name, param_tree, level_num, description_key=None, functions=None,
+                              word_list=None):
+        # description_key is the key of the section in the descriptions table, which starts with the command name.
+        # functions and word_list are passed to create_subcommand_switch and create_compreply
         subcommands = param_tree.subcommands
         opts = param_tree.options
-        subcommand_switch = self.create_subcommand_switch(cmd_name, level_num, subcommands, opts)
-        res = SECTION_TEMPLATE.format(cmd_name=cmd_name,
-                                      level_num=level_num,
-                                      compreply=self.create_compreply(param_tree),
-                                      subcommand_switch=subcommand_switch,
-                                      op="eq" if len(subcommands) > 0 else 'ge')
-        for subcommand_name, subcommand_tree in subcommands.items():
-            res += self.create_section("{0}_{1}".format(cmd_name, subcommand_name),
-                                       subcommand_tree,
-                                       option_help,
-                                       level_num+1)
-        return res
+        subcommand_switch = self.create_subcommand_switch(cmd_name, level_num, subcommands, opts, functions)
+        describe = ""
+        if self.descriptions and description_key is not None:
+            describe = SECTION_DESCRIBE_TEMPLATE.format(description_key.split(" ")[0], description_key)
+        values = ""
+        if self.dynamic_values and description_key is not None and param_tree.arguments:
+            name, _, path = description_key.partition(" ")
+            arguments = " ".join("'{0}'".format(argument) for argument in param_tree.arguments)
+            values = SECTION_VALUES_TEMPLATE.format(name, path, level_num, arguments)
+        return SECTION_TEMPLATE.format(cmd_name=cmd_name,
+                                       level_num=level_num,
+                                       compreply=self.create_compreply(param_tree, word_list),
+                                       values=values,
+                                       describe=describe,
+                                       subcommand_switch=subcommand_switch,
+                                       op="eq" if len(subcommands) > 0 else 'ge')
+
+    def iter_sections(self, cmd_name, param_tree, option_help, level_num, path=(), name=None):
+        # path is the tuple of subcommand names leading to param_tree, and name is the sanitized command name
+        name = name or cmd_name
+        if self.share_fragments:
+            for chunk in self._iter_shared_sections(cmd_name, param_tree, option_help, level_num, path, name):
+                yield chunk
+            return
+        for subcommand_path, subcommand_tree in param_tree.walk(path):
+            section_name = "_".join((cmd_name,) + subcommand_path[len(path):])
+            section_level_num = level_num + len(subcommand_path) - len(path)
+            yield self.create_single_section(section_name, subcommand_tree, section_level_num,
+                                             " ".join((name,) + subcommand_path))
+
+    def _get_section_key(self, path, param_tree, child_keys, help_index):
+        # everything that the section of param_tree renders, apart from its name
+        key = (len(path), tuple(param_tree.options), tuple(param_tree.arguments), tuple(param_tree.subcommands),
+               child_keys)
+        if self.descriptions:
+            key += (tuple(self.get_description_displays(param_tree, help_index, path)),)
+        if self.dynamic_values and param_tree.arguments:
+            # the daemon is asked for the values of the subcommand path
+            key += (path,)
+        return key
+
+    def find_shared_subtrees(self, param_tree, option_help, path=()):
+        help_index = HelpIndex.from_option_help(option_help) if self.descriptions else None
+        return SharedSubtrees(param_tree, lambda node_path, node, child_keys:
+                              self._get_section_key(node_path, node, child_keys, help_index), path)
+
+    def _iter_shared_sections(self, cmd_name, param_tree, option_help, level_num, path, name):
+        shared = self.find_shared_subtrees(param_tree, option_help, path)
+        def get_function(subcommand_path):
+            return "_".join((cmd_name,) + shared.get_canonical_path(subcommand_path)[len(path):])
+        word_lists = SharedFragments((self.create_word_list(node) for _, node in shared.iter_canonical()),
+                                     cmd_name + "_words_{0}", MIN_SHARED_WORDS_LENGTH)
+        for variable, words in word_lists.definitions:
+            yield SHARED_WORDS_TEMPLATE.format(variable, words)
+        for subcommand_path, subcommand_tree in shared.iter_canonical():
+            functions = dict((subcommand_name, get_function(subcommand_path + (subcommand_name,)))
+                             for subcommand_name in subcommand_tree.subcommands)
+            variable = word_lists.get_name(self.create_word_list(subcommand_tree))
+            yield self.create_single_section(get_function(subcommand_path), subcommand_tree,
+                                             level_num + len(subcommand_path) - len(path),
+                                             " ".join((name,) + subcommand_path), functions,
+                                             SHARED_WORDS_REFERENCE.format(variable) if variable else None)
+
+    def create_section(self, cmd_name, param_tree, option_help, level_num):
+        return "".join(self.iter_sections(cmd_name, param_tree, option_help, level_num))
 
     def sanitize_name(self, name):
         # some bash versions don't support ".", "-", etc. in function names
         valid_chars = string.ascii_letters + string.digits + "_"
         return "".join([char for char in name if char in valid_chars])
 
+    def get_description_displays(self, param_tree, help_index, path):
+        """Returns (word, display string) for the options and subcommands of param_tree that have a description"""
+        descriptions = [(option, help_index.get_option_help(option)) for option in param_tree.options]
+        descriptions += [(subcommand, help_index.get_subcommand_help(path + (subcommand,)))
+                         for subcommand in param_tree.subcommands]
+        descriptions = [(word, description) for word, description in descriptions if description]
+        width = max([len(word) for word, _ in descriptions] or [0])
+        return [(word, DESCRIPTION_DISPLAY_TEMPLATE.format(word.ljust(width), description))
+                for word, description in descriptions]
+
+    def iter_descriptions(self, name, param_tree, option_help, path=(), recursive=True):
+        help_index = HelpIndex.from_option_help(option_help)
+        separator = DESCRIPTIONS_START_TEMPLATE.format(name=name)
+        # the sections that share another section's function use its descriptions too
+        shared = None
+        if self.share_fragments and recursive:
+            shared = self.find_shared_subtrees(param_tree, option_help, path)
+        for subcommand_path, subcommand_tree in param_tree.walk(path, None if recursive else lambda node: {}):
+            if shared is not None and not shared.is_canonical(subcommand_path):
+                continue
+            key = " ".join((name,) + subcommand_path)
+            for word, display in self.get_description_displays(subcommand_tree, help_index, subcommand_path):
+                yield separator + FLAT_ENTRY_TEMPLATE.format(key + " " + word, display.replace("'", "'\\''"))
+                separator = "\n"
+        if separator == "\n":
+            yield FLAT_TABLE_END
+
+    def _get_flat_table_value(self, table, param_tree):
+        if table == "words":
+            return self.create_word_list(param_tree)
+        if table == "files":
+            return 1 if param_tree.arguments else None
+        if table == "arguments":
+            return " ".join(param_tree.arguments) or None
+        return 1 if not param_tree.subcommands else None
+
+    def iter_flat_table(self, name, table, param_tree):
+        yield FLAT_TABLE_START_TEMPLATE.format(name=name, table=table)
+        separator = ""
+        for path, subcommand_tree in param_tree.walk():
+            value = self._get_flat_table_value(table, subcommand_tree)
+            if value is None:
+                continue
+            # bash doesn't allow empty keys, so the keys start with the command name
+            key = " ".join((name,) + path)
+            yield separator + FLAT_ENTRY_TEMPLATE.format(key, value)
+            separator = "\n"
+        yield FLAT_TABLE_END
+
+    def iter_flat_completion_file_content(self, cmd, param_tree, option_help):
+        name = self.sanitize_name(cmd)
+        yield "\n"
+        for table in FLAT_TABLES + (["arguments"] if self.dynamic_values else []):
+            for chunk in self.iter_flat_table(name, table, param_tree):
+                yield chunk
+        values = ""
+        if self.dynamic_values:
+            yield VALUES_TEMPLATE.format(name=name, cmd=cmd)
+            values = FLAT_VALUES_TEMPLATE.format(name=name)
+        describe = ""
+        if self.descriptions:
+            yield DESCRIBE_TEMPLATE.format(name=name)
+            for chunk in self.iter_descriptions(name, param_tree, option_help):
+                yield chunk
+            describe = FLAT_DESCRIBE_TEMPLATE.format(name)
+        yield FLAT_FUNCTION_TEMPLATE.format(name=name, cmd=cmd, values=values, describe=describe)
+
+    def get_flat_completion_file_content(self, cmd, param_tree, option_help):
+        return "".join(self.iter_flat_completion_file_content(cmd, param_tree, option_help))
+
+    def iter_completion_file_content(self, cmd, param_tree, option_help):
+        if self.flat:
+            for chunk in self.iter_flat_completion_file_content(cmd, param_tree, option_help):
+                yield chunk
+            return
+        name = self.sanitize_name(cmd)
+        if self.dynamic_values:
+            yield VALUES_TEMPLATE.format(name=name, cmd=cmd)
+        if self.descriptions:
+            yield DESCRIBE_TEMPLATE.format(name=name)
+            for chunk in self.iter_descriptions(name, param_tree, option_help):
+                yield chunk
+        for chunk in self.iter_sections(name, param_tree, option_help, 1):
+            yield chunk
+        yield FILE_END_TEMPLATE.format(None, name, cmd)
+
     def get_completion_file_content(self, cmd, param_tree, option_help):
-        completion_file_inner_content = self.create_section(self.sanitize_name(cmd), param_tree, option_help, 1)
-        return FILE_TEMPLATE.format(completion_file_inner_content, self.sanitize_name(cmd), cmd)
+        return "".join(self.iter_completion_file_content(cmd, param_tree, option_help))
 
 class ManualBashCompletion(BashCompletion):
     def get_completion_path(self):
         return "."
+
+class BashLazyCompletion(BashCompletion):
+    """Generates completion files for bash-completion's on-demand loader, which sources the file of a command
+    the first time the command is completed, rather than at every shell start"""
+    def __init__(self, flat=False, split=False, descriptions=False, dynamic_values=False, share_fragments=False):
+        # split: write the sections of every top-level subcommand to a separate file, which is sourced the first
+        # time the subcommand is completed. not used in flat mode
+        super(BashLazyCompletion, self).__init__(flat, descriptions, dynamic_values, share_fragments)
+        self.split = split
+
+    def get_name(self):
+        return "BASH with bash-completion (on-demand loading)"
+
+    def get_completion_path(self):
+        completion_paths = self.get_completion_dirs().get_bash_completion_dirs()
+        return completion_paths[0] if completion_paths else "/usr/share/bash-completion/completions"
+
+    def get_completion_filepath(self, cmd):
+        # the loader looks for a file named exactly like the command
+        return os.path.join(self.get_completion_path(), cmd)
+
+    def get_parts_dir(self, cmd):
+        return "{0}.d".format(cmd)
+
+    def _is_split(self, param_tree):
+        return self.split and not self.flat and len(param_tree.subcommands) > 0
+
+    def iter_completion_file_content(self, cmd, param_tree, option_help):
+        if not self._is_split(param_tree):
+            for chunk in super(BashLazyCompletion, self).iter_completion_file_content(cmd, param_tree, option_help):
+                yield chunk
+            return
+        name = self.sanitize_name(cmd)
+        yield PARTS_DIR_TEMPLATE.format(name=name, parts_dir=self.get_parts_dir(cmd))
+        if self.dynamic_values:
+            yield VALUES_TEMPLATE.format(name=name, cmd=cmd)
+        if self.descriptions:
+            # the descriptions of the subcommands' sections are added by their files
+            yield DESCRIBE_TEMPLATE.format(name=name)
+            for chunk in self.iter_descriptions(name, param_tree, option_help, recursive=False):
+                yield chunk
+        yield self.create_single_section(name, param_tree, 1, name)
+        for subcommand_name in param_tree.subcommands:
+            yield STUB_SECTION_TEMPLATE.format(name=name, subcommand=subcommand_name)
+        yield FILE_END_TEMPLATE.format(None, name, cmd)
+
+    def iter_auxiliary_files(self, cmd, param_tree, option_help):
+        if not self._is_split(param_tree):
+            return
+        name = self.sanitize_name(cmd)
+        for subcommand_name, subcommand_tree in param_tree.subcommands.items():
+            yield (os.path.join(self.get_parts_dir(cmd), subcommand_name),
+                   self._iter_part_file(name, subcommand_name, subcommand_tree, option_help))
+
+    def _iter_part_file(self, name, subcommand_name, param_tree, option_help):
+        if self.descriptions:
+            for chunk in self.iter_descriptions(name, param_tree, option_help, (subcommand_name,)):
+                yield chunk
+        for chunk in self.iter_sections("{0}_{1}".format(name, subcommand_name), param_tree, option_help, 2,
+                                        (subcommand_name,), name):
+            yield chunk
+
+    def get_auxiliary_files(self, cmd, param_tree, option_help):
+        return [(relative_path, "".join(chunks))
+                for relative_path, chunks in self.iter_auxiliary_files(cmd, param_tree, option_help)]
+
+class ManualBashLazyCompletion(BashLazyCompletion):
+    def get_completion_path(self):
+        return "."
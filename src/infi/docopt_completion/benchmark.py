@@ -0,0 +1,358 @@
+"""Benchmarks the completion generation stages and the generated bash scripts on synthetic docopt usage texts.
+Run with "python -m infi.docopt_completion.benchmark".
+
+Usage:
+    benchmark [options]
+
+Options:
+    --fanout=<n>            Number of subcommands of every command [default: 4]
+    --depth=<n>             Number of subcommand levels [default: 3]
+    --options=<n>           Number of options in every usage line [default: 5]
+    --arguments=<n>         Number of positional arguments in every usage line [default: 1]
+    --repeat=<n>            Run every stage this many times and keep the fastest run [default: 5]
+    --tab-repeat=<n>        Number of completions to average in every TAB latency measurement [default: 200]
+    --output=<file>         Write the results to a file instead of the standard output
+    --compare=<file>        Compare the results with the results of a previous run
+    --check-import-time     Only check that importing the docopt-completion entry point fits in the import budget
+                            and doesn't import the modules it only needs later. Exits with 1 if it doesn't
+    --import-budget=<usec>  The import time budget, in microseconds [default: {0}]
+    --check-parser          Only check that the linear parser gives the same results as docopt's parser on the
+                            synthetic usage texts of every fanout and depth up to --fanout and --depth, and on
+                            usage texts that use all of docopt's syntax. Exits with 1 if it doesn't
+"""
+from __future__ import print_function
+import json
+import re
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from .common import CommandParams, build_command_tree, parse_params, parse_usage
+from .bash import BashCompletion
+from .zsh import ZshCompletion
+
+BENCHMARK_FORMAT_VERSION = 2
+
+ENTRY_POINT_MODULE = "infi.docopt_completion.docopt_completion"
+
+# python -X importtime measures the import of the entry point without the interpreter's startup.
+# the budget is generous, so only a real regression (like importing pkg_resources again) fails the check
+IMPORT_TIME_BUDGET_USEC = 100000
+
+# modules that importing the entry point must not import. they are imported when they are used
+LAZY_IMPORTS = ["pkg_resources", "multiprocessing", "infi.docopt_completion.bash", "infi.docopt_completion.zsh",
+                "infi.docopt_completion.cache", "infi.docopt_completion.daemon", "infi.docopt_completion.discovery",
+                "infi.docopt_completion.watch", "infi.docopt_completion.scan", "infi.docopt_completion.bundle",
+                "infi.docopt_completion.usage_parser"]
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)\s*$")
+
+COMMAND_NAME = "bench"
+
+# usage texts with groups, alternatives, repetitions, stacked short options and options that take the next word as
+# their argument, for checking the linear parser
+PARSER_CHECK_USAGES = ["""Naval Fate.
+
+Usage:
+  naval ship new <name>...
+  naval ship <name> move <x> <y> [--speed=<kn>]
+  naval ship shoot <x> <y>
+  naval mine (set|remove) <x> <y> [--moored | --drifting]
+  naval -h | --help
+  naval --version
+
+Options:
+  -h --help     Show this screen.
+  --version     Show version.
+  --speed=<kn>  Speed in knots [default: 10].
+  --moored      Moored (anchored) mine.
+  --drifting    Drifting mine.
+""", """Usage:
+  prog [options] (add | rm [-f]) <path>... [-vq] [--out FILE]
+  prog remote [add <name> [<url>] | rm <name>] -o FILE
+  prog (a b | c) d... [e f] ... g
+  prog ... | --
+  prog -h | --help
+
+Options:
+  -o FILE, --output FILE  Where to write [default: out.txt].
+  -v --verbose  Be verbose.
+  -q  Be quiet.
+  --out=FILE  Another output.
+  -f, --force  Force.
+
+Commands:
+  remote add  Add a remote.
+"""]
+
+# sources a generated completion file and completes the same words tab_repeat times.
+# prints the time it took to source the file and the average time of a completion, in microseconds
+TAB_DRIVER_TEMPLATE = """
+_usec() {{ local t=${{EPOCHREALTIME/[.,]/}}; echo $((10#$t)); }}
+start=$(_usec)
+source {script}
+sourced=$(_usec)
+COMP_WORDS=({words})
+COMP_CWORD={cword}
+for ((i = 0; i < {tab_repeat}; i++)); do
+    _{name}
+done
+end=$(_usec)
+echo $((sourced - start)) $(((end - sourced) / {tab_repeat})) ${{#COMPREPLY[@]}}
+"""
+
+
+def generate_usage(fanout, depth, options, arguments, name=COMMAND_NAME):
+    """Returns a docopt usage text with fanout ** depth usage lines, one for every subcommand path.
+    Every usage line has the same options (half of them taking a value) and its own positional arguments.
+    The options and the subcommands have descriptions, like the ones parsed for zsh completion"""
+    def option(index):
+        return "--opt{0}=<value>".format(index) if index % 2 else "--opt{0}".format(index)
+
+    paths = [()]
+    for level in range(depth):
+        paths = [path + ("c{0}".format(index),) for path in paths for index in range(fanout)]
+    lines = ["Usage:"]
+    for path in paths:
+        words = [name] + list(path)
+        words += ["<arg{0}>".format(index) for index in range(arguments)]
+        words += ["[{0}]".format(option(index)) for index in range(options)]
+        lines.append("  " + " ".join(words))
+    lines.append("  {0} -h | --help".format(name))
+    lines += ["", "Options:", "  -h --help  Show this screen."]
+    lines += ["  {0}  Synthetic option number {1}.".format(option(index), index) for index in range(options)]
+    lines += ["", "Commands:"]
+    lines += ["  {0}  Synthetic command {0}.".format(" ".join(path)) for path in paths]
+    return "\n".join(lines) + "\n"
+
+
+class _StaticUsageCapturer(object):
+    # replaces the --help subprocess with a fixed usage text
+    def __init__(self, usage):
+        self.usage = usage
+
+    def get_usage(self, cmd):
+        return self.usage
+
+
+def _time(func, repeat):
+    # returns the time of the fastest run, and the result of the last one
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        result = func()
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _count_nodes(param_tree):
+    return sum(1 for _ in param_tree.walk())
+
+
+def get_generators():
+    """The generators to benchmark, by name"""
+    return [("bash", BashCompletion()),
+            ("bash-flat", BashCompletion(flat=True)),
+            ("bash-descriptions", BashCompletion(descriptions=True)),
+            ("bash-shared", BashCompletion(share_fragments=True)),
+            ("zsh", ZshCompletion()),
+            ("zsh-autoload", ZshCompletion(autoload=True)),
+            ("zsh-shared", ZshCompletion(share_fragments=True))]
+
+
+def _render(generator, param_tree, option_help):
+    content = generator.get_completion_file_content(COMMAND_NAME, param_tree, option_help)
+    auxiliary_files = generator.get_auxiliary_files(COMMAND_NAME, param_tree, option_help)
+    return content, auxiliary_files
+
+
+def measure_tab_latency(script_content, words, tab_repeat, name=COMMAND_NAME):
+    """Sources a generated bash completion script and completes the given words (COMP_WORDS, with the last
+    word being completed). Returns a dict of the source time and the average completion time in microseconds,
+    or None if bash can't be run"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        script_path = os.path.join(temp_dir, "completion.sh")
+        with open(script_path, "w") as fd:
+            fd.write(script_content)
+        driver = TAB_DRIVER_TEMPLATE.format(script=script_path, name=name, tab_repeat=tab_repeat,
+                                            words=" ".join("'{0}'".format(word) for word in words),
+                                            cword=len(words) - 1)
+        try:
+            output = subprocess.check_output(["bash", "--norc", "--noprofile", "-c", driver], cwd=temp_dir)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    finally:
+        shutil.rmtree(temp_dir)
+    source_usec, tab_usec, candidates = [int(value) for value in output.split()]
+    return dict(source_usec=source_usec, tab_usec=tab_usec, candidates=candidates)
+
+
+def _get_source_root():
+    # the directory that contains the infi package this module was imported from
+    return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure_import_time(module=ENTRY_POINT_MODULE, repeat=5):
+    """Imports a module in a new interpreter with -X importtime, repeat times. Returns a dict of the fastest
+    cumulative import time in microseconds and the names of the modules it imported, or None if the interpreter
+    doesn't support -X importtime (python 3.7 and later do)"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([_get_source_root()] + [path for path in [env.get("PYTHONPATH")] if path])
+    best = None
+    modules = []
+    for _ in range(repeat):
+        try:
+            process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import " + module],
+                                       env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            return None
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            return None
+        imported = {}
+        for line in stderr.decode("utf-8", "replace").splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match:
+                imported[match.group(4)] = int(match.group(2))
+        if module not in imported:
+            return None
+        if best is None or imported[module] < best:
+            best = imported[module]
+            modules = sorted(imported)
+    return dict(usec=best, modules=modules)
+
+
+def check_import_time(budget=IMPORT_TIME_BUDGET_USEC, repeat=5):
+    """Returns a list of the problems found in the import of the entry point. An empty list means it passed.
+    With budget None, only the lazy imports are checked"""
+    result = measure_import_time(repeat=repeat)
+    if result is None:
+        return ["Failed to measure the import time with python -X importtime"]
+    problems = []
+    if budget is not None and result["usec"] > budget:
+        problems.append("Importing {0} took {1}us, the budget is {2}us".format(ENTRY_POINT_MODULE, result["usec"],
+                                                                            budget))
+    for module in LAZY_IMPORTS:
+        if module in result["modules"]:
+            problems.append("Importing {0} imports {1}".format(ENTRY_POINT_MODULE, module))
+    return problems
+
+
+def run_benchmark(fanout, depth, options, arguments, repeat=5, tab_repeat=200):
+    """Runs all the stages and returns the results as a JSON-compatible dict"""
+    from docopt import parse_defaults, parse_pattern, formal_usage, printable_usage
+    usage = generate_usage(fanout, depth, options, arguments)
+    capturer = _StaticUsageCapturer(usage)
+    stages = {}
+
+    elapsed, (param_tree, option_help) = _time(lambda: parse_params(COMMAND_NAME, capturer=capturer), repeat)
+    stages["parse_params"] = dict(seconds=elapsed)
+
+    for parser in ["docopt", "linear"]:
+        elapsed, _ = _time(lambda: parse_usage(usage, parser), repeat)
+        stages["parse_usage_" + parser] = dict(seconds=elapsed)
+
+    pattern = parse_pattern(formal_usage(printable_usage(usage)), parse_defaults(usage))
+    elapsed, _ = _time(lambda: build_command_tree(pattern, CommandParams()), repeat)
+    stages["build_command_tree"] = dict(seconds=elapsed, nodes=_count_nodes(param_tree))
+
+    deepest_path = [COMMAND_NAME] + ["c{0}".format(fanout - 1)] * depth
+    tab_words = {"root": [COMMAND_NAME, ""], "deep": deepest_path + ["--opt"]}
+    for generator_name, generator in get_generators():
+        elapsed, (content, auxiliary_files) = _time(lambda: _render(generator, param_tree, option_help), repeat)
+        stage = dict(seconds=elapsed,
+                     bytes=len(content.encode("utf-8")),
+                     auxiliary_bytes=sum(len(aux_content.encode("utf-8")) for _, aux_content in auxiliary_files),
+                     files=1 + len(auxiliary_files))
+        if generator_name.startswith("bash"):
+            for words_name, words in sorted(tab_words.items()):
+                stage["tab_" + words_name] = measure_tab_latency(content, words, tab_repeat)
+        stages["render_" + generator_name] = stage
+
+    import_time = measure_import_time(repeat=repeat)
+    if import_time is not None:
+        stages["import"] = dict(usec=import_time["usec"], modules=len(import_time["modules"]))
+
+    return dict(version=BENCHMARK_FORMAT_VERSION,
+                python=platform.python_version(),
+                parameters=dict(fanout=fanout, depth=depth, options=options, arguments=arguments,
+                                repeat=repeat, tab_repeat=tab_repeat),
+                usage_bytes=len(usage.encode("utf-8")),
+                stages=stages)
+
+
+def check_parser(fanout, depth, options, arguments):
+    """Returns a list of the usage texts that the linear parser parses differently from docopt's parser"""
+    from .usage_parser import compare_parsers
+    usages = [("{0}x{1}".format(usage_fanout, usage_depth),
+               generate_usage(usage_fanout, usage_depth, options, arguments))
+              for usage_fanout in range(1, fanout + 1) for usage_depth in range(1, depth + 1)]
+    usages += [("example {0}".format(index + 1), usage) for index, usage in enumerate(PARSER_CHECK_USAGES)]
+    problems = []
+    for name, usage in usages:
+        problems.extend("{0}: {1}".format(name, difference) for difference in compare_parsers(usage))
+    return problems
+
+
+def _flatten(results, prefix=""):
+    # yields (metric name, value) for every number in the results
+    for key, value in sorted(results.items()):
+        name = prefix + key
+        if isinstance(value, dict):
+            for item in _flatten(value, name + "."):
+                yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare_results(previous, current):
+    """Returns a list of (metric name, previous value, current value, ratio) for the metrics found in both runs"""
+    previous_metrics = dict(_flatten(previous.get("stages", {})))
+    comparison = []
+    for name, value in _flatten(current.get("stages", {})):
+        if name in previous_metrics:
+            previous_value = previous_metrics[name]
+            ratio = float(value) / previous_value if previous_value else None
+            comparison.append((name, previous_value, value, ratio))
+    return comparison
+
+
+def main(argv=None):
+    import docopt
+    arguments = docopt.docopt(__doc__.format(IMPORT_TIME_BUDGET_USEC), argv)
+    if arguments["--check-import-time"]:
+        problems = check_import_time(int(arguments["--import-budget"]), int(arguments["--repeat"]))
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        return 1 if problems else 0
+    if arguments["--check-parser"]:
+        problems = check_parser(int(arguments["--fanout"]), int(arguments["--depth"]), int(arguments["--options"]),
+                                int(arguments["--arguments"]))
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        return 1 if problems else 0
+    results = run_benchmark(int(arguments["--fanout"]), int(arguments["--depth"]), int(arguments["--options"]),
+                            int(arguments["--arguments"]), int(arguments["--repeat"]), int(arguments["--tab-repeat"]))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if arguments["--output"]:
+        with open(arguments["--output"], "w") as fd:
+            fd.write(output + "\n")
+    else:
+        print(output)
+    if arguments["--compare"]:
+        with open(arguments["--compare"]) as fd:
+            previous = json.load(fd)
+        for name, previous_value, value, ratio in compare_results(previous, results):
+            ratio_text = "{0:.2f}x".format(ratio) if ratio is not None else "-"
+            print("{0:<45} {1:>14.6g} {2:>14.6g} {3:>8}".format(name, previous_value, value, ratio_text),
+                  file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""Writes the completion files of many commands, for several shells, into a staging directory or a single archive,
+to be shipped by an OS package instead of running docopt-completion on the target hosts.
+
+The files are laid out as they are installed (bash-completion's and zsh's site directories under usr/share), and
+a manifest next to the staging directory or the archive (not in it, so it isn't installed with the files) lists the
+path, size and SHA-256 hash of every file. Each file is written with a single write, and nothing is synced to disk
+until the bundle is closed, and then only if fsync is requested.
+"""
+import hashlib
+import io
+import json
+import os
+import time
+from .common import DocoptCompletionException, WRITTEN, UNCHANGED, STRING_TYPES
+from .bash import BashLazyCompletion
+from .zsh import ZshCompletion
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_FORMAT_VERSION = 1
+
+BASH_INSTALL_DIR = os.path.join("usr", "share", "bash-completion", "completions")
+ZSH_INSTALL_DIR = os.path.join("usr", "share", "zsh", "site-functions")
+
+SHELLS = ["bash", "zsh"]
+
+TAR_MODES = [(".tar.gz", "w:gz"), (".tgz", "w:gz"), (".tar.bz2", "w:bz2"), (".tar.xz", "w:xz"), (".tar", "w")]
+
+FILE_MODE = 0o644
+
+
+def _get_timestamp():
+    # archives use $SOURCE_DATE_EPOCH when it's set, so that builds are reproducible
+    try:
+        return int(os.environ["SOURCE_DATE_EPOCH"])
+    except (KeyError, ValueError):
+        return int(time.time())
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_manifest_path(path):
+    """Returns the path of the manifest of the bundle at path"""
+    return path.rstrip(os.sep) + MANIFEST_SUFFIX
+
+
+class Bundle(object):
+    """Collects completion files by their relative paths, and writes them with a manifest.
+    Subclasses write the files to a directory or an archive"""
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        # relative path -> (sha256, size)
+        self.files = {}
+
+    def add(self, relative_path, content):
+        """Adds a file, whose content is a string or an iterable of strings. Returns (status, size).
+        A file that was already added with the same content, like a helper shared by several commands, is skipped"""
+        if isinstance(content, STRING_TYPES):
+            content = [content]
+        data = "".join(content).encode("utf-8")
+        relative_path = os.path.normpath(relative_path).replace(os.sep, "/")
+        digest = hashlib.sha256(data).hexdigest()
+        if relative_path in self.files:
+            if self.files[relative_path][0] != digest:
+                raise DocoptCompletionException("Two different files are bundled as {0}".format(relative_path))
+            return UNCHANGED, len(data)
+        self.files[relative_path] = (digest, len(data))
+        self._write(relative_path, data)
+        return WRITTEN, len(data)
+
+    def get_manifest(self):
+        return dict(version=MANIFEST_FORMAT_VERSION,
+                    files=[dict(path=relative_path, size=size, sha256=digest)
+                           for relative_path, (digest, size) in sorted(self.files.items())])
+
+    def close(self):
+        self._finish()
+        self._write_manifest()
+
+    def _write_manifest(self):
+        # the manifest is written when the bundle is complete, and replaces an older manifest only once it's written
+        import tempfile
+        manifest_path = get_manifest_path(self.path)
+        dirname, basename = os.path.split(os.path.abspath(manifest_path))
+        fd, temp_path = tempfile.mkstemp(dir=dirname, prefix=".{0}.".format(basename), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write((json.dumps(self.get_manifest(), indent=2, sort_keys=True) + "\n").encode("utf-8"))
+                temp_file.flush()
+                if self.fsync:
+                    os.fsync(temp_file.fileno())
+            os.chmod(temp_path, FILE_MODE)
+            os.rename(temp_path, manifest_path)
+        except:
+            os.remove(temp_path)
+            raise
+        if self.fsync:
+            _fsync_path(dirname)
+
+    def abort(self):
+        pass
+
+    def _write(self, relative_path, data):
+        raise NotImplementedError()
+
+    def _finish(self):
+        raise NotImplementedError()
+
+
+class DirectoryBundle(Bundle):
+    """Writes the files to a staging directory, which must be empty or not exist, so the tree only contains the files
+    in the manifest"""
+    def __init__(self, path, fsync=False):
+        if os.path.isdir(path) and os.listdir(path):
+            raise DocoptCompletionException("The staging directory {0} is not empty".format(path))
+        super(DirectoryBundle, self).__init__(path, fsync)
+        self.existed = os.path.isdir(path)
+        self.written_paths = []
+        self.created_dirs = set()
+
+    def _write(self, relative_path, data):
+        file_path = os.path.join(self.path, *relative_path.split("/"))
+        dirname = os.path.dirname(file_path)
+        if dirname not in self.created_dirs:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.created_dirs.add(dirname)
+        with open(file_path, "wb") as fd:
+            fd.write(data)
+        os.chmod(file_path, FILE_MODE)
+        self.written_paths.append(file_path)
+
+    def abort(self):
+        # the directory was empty, so everything in it was written by this bundle
+        import shutil
+        if not self.existed:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        for name in os.listdir(self.path):
+            entry_path = os.path.join(self.path, name)
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                shutil.rmtree(entry_path, ignore_errors=True)
+            else:
+                os.remove(entry_path)
+
+    def _finish(self):
+        if not self.fsync:
+            return
+        for file_path in self.written_paths:
+            _fsync_path(file_path)
+        for dirname in sorted(self.created_dirs, key=len, reverse=True):
+            _fsync_path(dirname)
+
+
+class _ArchiveBundle(Bundle):
+    # the archive is written to a temporary file next to it, which is renamed when the bundle is closed
+    def __init__(self, path, fsync=False):
+        super(_ArchiveBundle, self).__init__(path, fsync)
+        import tempfile
+        dirname, basename = os.path.split(os.path.abspath(path))
+        fd, self.temp_path = tempfile.mkstemp(dir=dirname, prefix=".{0}.".format(basename), suffix=".tmp")
+        self.temp_file = os.fdopen(fd, "w+b")
+        self.timestamp = _get_timestamp()
+        self.archive = self._open_archive(self.temp_file)
+
+    def _open_archive(self, fileobj):
+        raise NotImplementedError()
+
+    def _close_archive(self):
+        self.archive.close()
+
+    def _finish(self):
+        self._close_archive()
+        self.temp_file.flush()
+        if self.fsync:
+            os.fsync(self.temp_file.fileno())
+        self.temp_file.close()
+        os.chmod(self.temp_path, FILE_MODE)
+        os.rename(self.temp_path, self.path)
+        if self.fsync:
+            _fsync_path(os.path.dirname(os.path.abspath(self.path)))
+
+    def abort(self):
+        try:
+            self._close_archive()
+        finally:
+            self.temp_file.close()
+            os.remove(self.temp_path)
+
+
+class TarBundle(_ArchiveBundle):
+    """Writes the files to a tar archive, compressed according to the extension of its path"""
+    def _open_archive(self, fileobj):
+        import tarfile
+        mode = [tar_mode for extension, tar_mode in TAR_MODES if self.path.endswith(extension)][0]
+        self.compressor = None
+        if mode == "w:gz":
+            # tarfile would put the current time in the gzip header
+            import gzip
+            self.compressor = gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, mtime=self.timestamp)
+            return tarfile.open(mode="w", fileobj=self.compressor)
+        return tarfile.open(mode=mode, fileobj=fileobj)
+
+    def _close_archive(self):
+        self.archive.close()
+        if self.compressor is not None:
+            self.compressor.close()
+
+    def _write(self, relative_path, data):
+        import tarfile
+        info = tarfile.TarInfo(relative_path)
+        info.size = len(data)
+        info.mode = FILE_MODE
+        info.mtime = self.timestamp
+        info.uname = info.gname = "root"
+        self.archive.addfile(info, io.BytesIO(data))
+
+
+class ZipBundle(_ArchiveBundle):
+    """Writes the files to a zip archive"""
+    def _open_archive(self, fileobj):
+        import zipfile
+        return zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+
+    def _write(self, relative_path, data):
+        import zipfile
+        # zip archives can't hold dates before 1980
+        info = zipfile.ZipInfo(relative_path, time.gmtime(max(self.timestamp, 315532800))[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = (0o100000 | FILE_MODE) << 16
+        self.archive.writestr(info, data)
+
+
+def open_bundle(path, fsync=False):
+    """Returns the bundle for a path: an archive for .zip and .tar (optionally .gz, .bz2 or .xz) paths,
+    and a staging directory otherwise"""
+    if path.endswith(".zip"):
+        return ZipBundle(path, fsync)
+    if any(path.endswith(extension) for extension, _ in TAR_MODES):
+        return TarBundle(path, fsync)
+    return DirectoryBundle(path, fsync)
+
+
+class _BundleGeneratorMixin(object):
+    # the completion files are added to the bundle under the install directory, instead of being written
+    install_dir = None
+
+    def get_completion_path(self):
+        return self.install_dir
+
+    def completion_path_exists(self):
+        return True
+
+    def _write_to_file(self, file_path, completion_file_content):
+        return self.bundle.add(file_path, completion_file_content)
+
+
+class BashBundleCompletion(_BundleGeneratorMixin, BashLazyCompletion):
+    """Adds the completion files for bash-completion's on-demand loader to a bundle"""
+    install_dir = BASH_INSTALL_DIR
+
+    def __init__(self, bundle, **options):
+        super(BashBundleCompletion, self).__init__(**options)
+        self.bundle = bundle
+
+
+class ZshBundleCompletion(_BundleGeneratorMixin, ZshCompletion):
+    """Adds the completion files for zsh's site-functions directory to a bundle. They aren't compiled with zcompile,
+    which is left to the target hosts"""
+    install_dir = ZSH_INSTALL_DIR
+
+    def __init__(self, bundle, **options):
+        options = dict(options, zcompile=False)
+        super(ZshBundleCompletion, self).__init__(**options)
+        self.bundle = bundle
+
+
+def get_bundle_generators(bundle, shells, bash_options=None, zsh_options=None):
+    """Returns the generators that add the completion files of the given shells (see SHELLS) to a bundle"""
+    unknown_shells = [shell for shell in shells if shell not in SHELLS]
+    if unknown_shells:
+        raise DocoptCompletionException("Unknown shells: {0}. Supported shells are {1}".format(
+                                        ", ".join(unknown_shells), ", ".join(SHELLS)))
+    generators = []
+    if "bash" in shells:
+        generators.append(BashBundleCompletion(bundle, **(bash_options or {})))
+    if "zsh" in shells:
+        generators.append(ZshBundleCompletion(bundle, **(zsh_options or {})))
+    return generators
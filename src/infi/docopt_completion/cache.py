@@ -0,0 +1,107 @@
+import os
+import hashlib
+import json
+from .common import dump_params, load_params
+
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+# bump this whenever the cached data changes, so old entries are never loaded
+CACHE_FORMAT_VERSION = 2
+
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+
+CACHE_FILE_SUFFIX = ".cache"
+
+
+def get_default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(cache_home, "docopt-completion")
+
+
+def resolve_executable(cmd):
+    """Returns the real path of the file that runs when executing cmd, or None if it can't be found"""
+    path = cmd if os.path.dirname(cmd) else find_executable(cmd)
+    if path is None or not os.path.isfile(path):
+        return None
+    return os.path.realpath(path)
+
+
+class UsageCache(object):
+    """On-disk cache of the usage text captured from a docopt script and the parse results.
+
+    Entries are keyed by the identity of the executable: its resolved path, size, mtime and content hash.
+    When the script changes, its key changes too and the old entry is eventually evicted.
+    The cache is bounded by the total size of its files; the least recently used entries are removed first.
+    """
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir or get_default_cache_dir()
+        self.max_size = max_size
+
+    def get_key(self, cmd):
+        path = resolve_executable(cmd)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+            with open(path, "rb") as fd:
+                content_hash = hashlib.sha256(fd.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+        identity = "{0}\0{1}\0{2}\0{3}\0{4}".format(CACHE_FORMAT_VERSION, path, stat.st_size,
+                                                     stat.st_mtime, content_hash)
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_FILE_SUFFIX)
+
+    def load(self, key):
+        """Returns a (usage, param_tree, option_help) tuple, or None if there is no valid entry"""
+        entry_path = self._get_entry_path(key)
+        try:
+            with open(entry_path, "rb") as fd:
+                entry = json.loads(fd.read().decode("utf-8"))
+            param_tree, option_help = load_params(entry["params"])
+            # mark the entry as recently used for the eviction
+            os.utime(entry_path, None)
+        except Exception:
+            return None
+        return entry["usage"], param_tree, option_help
+
+    def store(self, key, usage, param_tree, option_help):
+        import tempfile
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            entry = json.dumps({"usage": usage, "params": dump_params(param_tree, option_help)})
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(entry.encode("utf-8"))
+            os.rename(temp_path, self._get_entry_path(key))
+        except (IOError, OSError):
+            # the cache is an optimization, failing to write it is not an error
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        try:
+            for filename in os.listdir(self.cache_dir):
+                if not filename.endswith(CACHE_FILE_SUFFIX):
+                    continue
+                entry_path = os.path.join(self.cache_dir, filename)
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        except OSError:
+            return
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total_size -= size
@@ -0,0 +1,161 @@
+import os
+import subprocess
+import threading
+from .common import DocoptCompletionException
+from .process import clock, wait_process, kill_process
+from .stats import phase
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_OUTPUT_SIZE = 4 * 1024 * 1024
+DEFAULT_ENCODING = "utf-8"
+
+READ_SIZE = 64 * 1024
+
+# how long to wait for the pipes to close after killing a command that timed out
+KILL_GRACE_PERIOD = 1
+
+
+class HelpCapture(object):
+    """The output of a single "<cmd> --help" run, and what was observed while running it"""
+    def __init__(self, cmd, returncode, stdout, stderr, elapsed, timed_out, exceeded_max_size):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.exceeded_max_size = exceeded_max_size
+
+    @property
+    def stdout_size(self):
+        return len(self.stdout)
+
+    @property
+    def stderr_size(self):
+        return len(self.stderr)
+
+    def __repr__(self):
+        return "<HelpCapture {0!r}: returncode={1}, {2:.3f}s, stdout={3} bytes, stderr={4} bytes>".format(
+            self.cmd, self.returncode, self.elapsed, self.stdout_size, self.stderr_size)
+
+
+class _PipeDrainer(object):
+    # reads both pipes of a process on separate threads, so a process that fills the stderr pipe can't block
+    # while we're waiting for stdout. the process is killed once the total output exceeds max_output_size
+    def __init__(self, process, max_output_size):
+        self.process = process
+        self.max_output_size = max_output_size
+        self.total_size = 0
+        self.exceeded_max_size = False
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.stdout_chunks = []
+        self.stderr_chunks = []
+        # the threads read duplicates of the pipes, so the pipes can be closed while a thread is still reading
+        self.threads = [threading.Thread(target=self._drain, args=(os.dup(stream.fileno()), chunks))
+                        for stream, chunks in ((process.stdout, self.stdout_chunks),
+                                               (process.stderr, self.stderr_chunks))]
+        for thread in self.threads:
+            # if the process leaves its pipes to a child that keeps running, we don't wait for that child
+            thread.daemon = True
+            thread.start()
+
+    def _drain(self, fileno, chunks):
+        try:
+            while True:
+                chunk = os.read(fileno, READ_SIZE)
+                with self.lock:
+                    if not chunk or self.stopped:
+                        return
+                    if self.exceeded_max_size:
+                        continue
+                    self.total_size += len(chunk)
+                    if self.total_size > self.max_output_size:
+                        self.exceeded_max_size = True
+                        kill_process(self.process)
+                        continue
+                    chunks.append(chunk)
+        finally:
+            os.close(fileno)
+
+    def join(self, deadline):
+        for thread in self.threads:
+            thread.join(max(0, deadline - clock()))
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def stop(self):
+        """Returns the output read so far. Output that threads still running read later is discarded"""
+        with self.lock:
+            self.stopped = True
+            return b"".join(self.stdout_chunks), b"".join(self.stderr_chunks)
+
+
+class HelpCapturer(object):
+    """Runs commands with --help and captures their output.
+
+    Both pipes are drained concurrently. A command is killed if it doesn't finish within timeout seconds
+    or if its output exceeds max_output_size bytes. Every capture is kept in the captures list,
+    so the timing and sizes can be inspected after a batch run."""
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_output_size=DEFAULT_MAX_OUTPUT_SIZE, encoding=DEFAULT_ENCODING):
+        self.timeout = timeout
+        self.max_output_size = max_output_size
+        self.encoding = encoding
+        self.captures = []
+
+    def capture(self, cmd):
+        """Returns a HelpCapture. Raises OSError if the command can't be run"""
+        with phase("get_usage") as details:
+            capture = self._capture(cmd)
+            details["bytes"] = capture.stdout_size
+            details["stderr_bytes"] = capture.stderr_size
+        return capture
+
+    def _capture(self, cmd):
+        start = clock()
+        with open(os.devnull, "rb") as devnull:
+            process = subprocess.Popen([cmd, "--help"], stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            drainer = _PipeDrainer(process, self.max_output_size)
+            deadline = start + self.timeout
+            drained = drainer.join(deadline)
+            # a command may close its pipes and keep running, so the deadline applies to the process as well
+            returncode = wait_process(process, deadline)
+            timed_out = returncode is None
+            if timed_out:
+                kill_process(process)
+                returncode = process.wait()
+                if not drained:
+                    drainer.join(clock() + KILL_GRACE_PERIOD)
+            stdout, stderr = drainer.stop()
+            process.stdout.close()
+            process.stderr.close()
+        finally:
+            if process.poll() is None:
+                kill_process(process)
+                process.wait()
+        capture = HelpCapture(cmd, returncode, stdout, stderr, clock() - start, timed_out, drainer.exceeded_max_size)
+        self.captures.append(capture)
+        return capture
+
+    def get_usage(self, cmd):
+        error_message = "Failed to run '{cmd} --help'".format(cmd=cmd)
+        try:
+            capture = self.capture(cmd)
+        except OSError:
+            msg = "{error_message} : command does not exist"
+            raise DocoptCompletionException(msg.format(error_message=error_message))
+        if capture.timed_out:
+            msg = "{error_message} : command did not finish within {timeout} seconds"
+            raise DocoptCompletionException(msg.format(error_message=error_message, timeout=self.timeout))
+        if capture.exceeded_max_size:
+            msg = "{error_message} : command output exceeded {max_output_size} bytes"
+            raise DocoptCompletionException(msg.format(error_message=error_message,
+                                                       max_output_size=self.max_output_size))
+        if capture.returncode != 0:
+            msg = "{error_message} : command returned {returncode}"
+            raise DocoptCompletionException(msg.format(error_message=error_message, returncode=capture.returncode))
+        try:
+            return capture.stdout.decode(self.encoding)
+        except (UnicodeDecodeError, LookupError) as e:
+            msg = "{error_message} : failed to decode the output as {encoding} ({error})"
+            raise DocoptCompletionException(msg.format(error_message=error_message, encoding=self.encoding, error=e))
@@ -1,8 +1,16 @@
 from __future__ import print_function
-import subprocess
 import re
 import os
+import sys
+import json
 import types
+from .stats import phase, enabled as stats_enabled
+
+try:
+    intern = sys.intern
+except AttributeError:
+    # python 2, where intern is a builtin
+    pass
 
 
 class DocoptCompletionException(Exception):
@@ -23,63 +31,180 @@ def build_command_tree(pattern, cmd_params):
     elif type(pattern) in [Option]:
         suffix = "=" if pattern.argcount else ""
         if pattern.short:
-            cmd_params.options.append(pattern.short + suffix)
+            cmd_params.add_option(pattern.short + suffix)
         if pattern.long:
-            cmd_params.options.append(pattern.long + suffix)
+            cmd_params.add_option(pattern.long + suffix)
     elif type(pattern) in [Command]:
         cmd_params = cmd_params.get_subcommand(pattern.name)
     elif type(pattern) in [Argument]:
-        cmd_params.arguments.append(pattern.name)
+        cmd_params.add_argument(pattern.name)
     return cmd_params
 
 
-def get_usage(cmd):
-    error_message = "Failed to run '{cmd} --help'".format(cmd=cmd)
-    try:
-        cmd_process = subprocess.Popen([cmd, "--help"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except OSError:
-        raise DocoptCompletionException("{error_message} : command does not exist".format(error_message=error_message))
-    # Poll process for new output until finished
-    usage = bytes()
-    while True:
-        nextline = cmd_process.stdout.readline()
-        if len(nextline) == 0 and cmd_process.poll() is not None:
-            break
-        usage += nextline
-    if cmd_process.returncode != 0:
-        msg = "{error_message} : command returned {returncode}"
-        raise DocoptCompletionException(msg.format(error_message=error_message, returncode=cmd_process.returncode))
-    return usage.decode("ascii")
+def get_usage(cmd, capturer=None):
+    # runs "cmd --help" and returns its output. a HelpCapturer can be given to control the timeout,
+    # maximum output size and encoding, and to collect the timing of the run
+    if capturer is None:
+        from .capture import HelpCapturer
+        capturer = HelpCapturer()
+    return capturer.get_usage(cmd)
 
 
-def get_options_descriptions(doc):
-    def sanitize_line(line):
-        return line.replace("'", "'\\''").replace('[', '\\[').replace(']', '\\]').strip()
+def escape_zsh_description(description):
+    # descriptions are put in single quotes, inside the brackets of an _arguments or _values spec
+    return description.replace("'", "'\\''").replace('[', '\\[').replace(']', '\\]')
+
+
+def unescape_zsh_description(description):
+    return description.replace('\\]', ']').replace('\\[', '[').replace("'\\''", "'")
+
+
+def iter_line_descriptions(line):
+    """Yields (option or subcommand trail, description) for a line of a usage text that starts with two spaces"""
+    options, partition, description = line.strip().partition('  ')
+    if not partition:
+        return
+    if not options.startswith('-'):
+        yield options, description.strip()
+        return
+    options = options.replace(',', ' ')
+    options = re.sub("=\S+", "= ", options)
+    for s in options.split():
+        yield s, description.strip()
 
+
+def iter_descriptions(doc):
+    """Yields (option or subcommand trail, description) for every described line of a usage text"""
     for arg in re.findall('\n  .*', doc):
-        options, partition, description = arg.strip().partition('  ')
-        if not partition:
-            continue
-        if not options.startswith('-'):
-            yield options, sanitize_line(description)
-            continue
-        options = options.replace(',', ' ')
-        options = re.sub("=\S+", "= ", options)
-        for s in options.split():
-            yield s, sanitize_line(description)
-
-
-def parse_params(cmd):
-    # This creates a parameter tree (CommandParams object) for the target docopt tool.
-    # Also returns a second parameter, a dict of:
+        for item in iter_line_descriptions(arg):
+            yield item
+
+
+def get_options_descriptions(doc):
+    for key, description in iter_descriptions(doc):
+        yield key, escape_zsh_description(description)
+
+
+# usage texts from this size are parsed by the engine in usage_parser.py, whose time grows linearly with the size,
+# rather than by docopt's parser, whose time grows with the square of the number of usage lines
+LARGE_USAGE_SIZE = 32 * 1024
+
+PARSERS = ["docopt", "linear"]
+
+
+def get_program_name(usage_section):
+    """Returns the program name of a usage section (the word after "usage:"), or None if it has none"""
+    words = usage_section.split()
+    return words[1] if len(words) > 1 else None
+
+
+def parse_usage(usage, parser=None):
+    # This creates a parameter tree (CommandParams object) from a docopt usage text.
+    # Also returns a second parameter, a HelpIndex, which is a dict of:
     #   option->option-help-string
+    # parser is one of PARSERS, or None to choose by the size of the usage text. Both give the same results
+    if parser is None:
+        parser = "linear" if len(usage) >= LARGE_USAGE_SIZE else "docopt"
+    if parser == "linear":
+        from .usage_parser import parse_large_usage
+        return parse_large_usage(usage)
     from docopt import parse_defaults, parse_pattern, formal_usage, printable_usage
-    usage = get_usage(cmd)
-    options = parse_defaults(usage)
-    pattern = parse_pattern(formal_usage(printable_usage(usage)), options)
-    param_tree = CommandParams()
-    build_command_tree(pattern, param_tree)
-    return param_tree, dict(list(get_options_descriptions(usage)))
+    with phase("parse_defaults", bytes=len(usage)):
+        options = parse_defaults(usage)
+    with phase("parse_pattern", bytes=len(usage)):
+        usage_section = printable_usage(usage)
+        pattern = parse_pattern(formal_usage(usage_section), options)
+    with phase("build_command_tree") as details:
+        param_tree = CommandParams()
+        build_command_tree(pattern, param_tree)
+        if stats_enabled():
+            details["nodes"] = sum(1 for _ in param_tree.walk())
+    with phase("help_index") as details:
+        option_help = HelpIndex(iter_descriptions(usage), program_name=get_program_name(usage_section))
+        details["entries"] = len(option_help)
+    return param_tree, option_help
+
+
+def parse_params(cmd, cache=None, static=False, capturer=None, usage_index=None):
+    # This creates a parameter tree (CommandParams object) for the target docopt tool.
+    # If a usage_index is given (an EnvironmentIndex), the usage texts of the console scripts it found are used.
+    # If static is True, the usage text is first looked up in the tool's source code, without running it,
+    # and the tool is run if the text found can't be parsed.
+    # If a UsageCache is given, the results are taken from it when the tool hasn't changed since it was cached
+    if usage_index is not None:
+        usage = usage_index.get_usage(os.path.basename(cmd))
+        if usage is not None:
+            return parse_usage(usage)
+    if static:
+        from .static import get_static_usage
+        with phase("static_usage") as details:
+            usage = get_static_usage(cmd)
+            details["found"] = int(usage is not None)
+        if usage is not None:
+            from docopt import DocoptLanguageError
+            try:
+                return parse_usage(usage)
+            except DocoptLanguageError:
+                # the text found isn't a usage text docopt can parse, so the tool is run instead
+                pass
+    key = None
+    if cache is not None:
+        with phase("cache_lookup") as details:
+            key = cache.get_key(cmd)
+            entry = cache.load(key) if key is not None else None
+            details["hits"] = int(entry is not None)
+        if entry is not None:
+            _, param_tree, option_help = entry
+            return param_tree, option_help
+    usage = get_usage(cmd, capturer)
+    param_tree, option_help = parse_usage(usage)
+    if key is not None:
+        with phase("cache_store"):
+            cache.store(key, usage, param_tree, option_help)
+    return param_tree, option_help
+
+
+class OrderedSet(object):
+    """A list-like collection that ignores items it already contains, keeping the order they were first added"""
+    __slots__ = ("_items", "_index")
+
+    def __init__(self, items=()):
+        self._items = []
+        self._index = set()
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self._index:
+            self._index.add(item)
+            self._items.append(item)
+
+    append = add
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._items)
+
+
+# bump this when the serialized CommandParams or HelpIndex format changes
+SERIALIZATION_FORMAT_VERSION = 2
 
 
 class CommandParams(object):
@@ -95,14 +220,65 @@ class CommandParams(object):
 
     This way, we can describe commands like "git remote add origin --fetch" with all the different
     options at each level.
+
+    Options and arguments are kept in OrderedSets, so an option that appears in several usage lines
+    is only stored once. Names are interned, since the same names repeat throughout large trees.
     """
+    __slots__ = ("arguments", "options", "subcommands")
+
     def __init__(self):
-        self.arguments = []
-        self.options = []
+        self.arguments = OrderedSet()
+        self.options = OrderedSet()
         self.subcommands = {}
 
+    def add_option(self, option):
+        self.options.add(intern(option))
+
+    def add_argument(self, argument):
+        self.arguments.add(intern(argument))
+
     def get_subcommand(self, subcommand):
-        return self.subcommands.setdefault(subcommand, CommandParams())
+        if subcommand not in self.subcommands:
+            self.subcommands[intern(subcommand)] = CommandParams()
+        return self.subcommands[subcommand]
+
+    def walk(self, path=(), get_subcommands=None):
+        """Yields (path, CommandParams) for this command and all its subcommands, depth first.
+        path is the tuple of subcommand names leading from this command.
+        get_subcommands can be given to walk only some of the subcommands of every command.
+        The walk is iterative, so it isn't limited by the recursion limit"""
+        stack = [(path, self)]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            subcommands = node.subcommands if get_subcommands is None else get_subcommands(node)
+            stack.extend((path + (subcommand_name,), subcommand)
+                         for subcommand_name, subcommand in reversed(list(subcommands.items())))
+
+    def to_json_object(self):
+        """Returns a JSON-compatible representation: [options, arguments, [[subcommand name, subcommand], ...]].
+        Lists are used rather than objects so the order of the subcommands is kept by any JSON library"""
+        return [list(self.options), list(self.arguments),
+                [[name, subcommand.to_json_object()] for name, subcommand in self.subcommands.items()]]
+
+    @classmethod
+    def from_json_object(cls, json_object):
+        options, arguments, subcommands = json_object
+        param_tree = cls()
+        for option in options:
+            param_tree.add_option(option)
+        for argument in arguments:
+            param_tree.add_argument(argument)
+        for name, subcommand in subcommands:
+            param_tree.subcommands[intern(name)] = cls.from_json_object(subcommand)
+        return param_tree
+
+    def __eq__(self, other):
+        return (isinstance(other, CommandParams) and self.options == other.options and
+                self.arguments == other.arguments and self.subcommands == other.subcommands)
+
+    def __ne__(self, other):
+        return not self == other
 
     def repr(self, indent):
         s = " " * indent + "cmds:\n"
@@ -116,20 +292,283 @@ class CommandParams(object):
         return self.repr(0)
 
 
+class HelpIndex(dict):
+    """The descriptions of the options and subcommands of a usage text, indexed once when the usage is parsed.
+
+    As a dict, it maps option names (like "--speed=") and subcommand trails (like "ship new") to their descriptions,
+    escaped for zsh, as get_options_descriptions returns them. The raw descriptions are also indexed by option name
+    and by subcommand path tuple (without the program name), so generators look them up without building strings.
+    """
+    def __init__(self, descriptions=(), program_name=None):
+        super(HelpIndex, self).__init__()
+        self.program_name = program_name
+        self.descriptions = {}
+        self.options = {}
+        self.subcommands = {}
+        for key, description in descriptions:
+            self.add(key, description)
+
+    def add(self, key, description):
+        self.descriptions[key] = description
+        dict.__setitem__(self, key, escape_zsh_description(description))
+        if key.startswith("-"):
+            self.options[key] = description
+            return
+        path = tuple(key.split())
+        if path and path[0] == self.program_name:
+            path = path[1:]
+        self.subcommands[path] = description
+
+    def get_option_help(self, option):
+        return self.options.get(option)
+
+    def get_subcommand_help(self, path):
+        """Returns the description of the subcommand at path, a tuple of subcommand names, or None"""
+        return self.subcommands.get(path)
+
+    @classmethod
+    def from_option_help(cls, option_help):
+        """Returns the HelpIndex of a dict returned by an older version of parse_params"""
+        if isinstance(option_help, cls):
+            return option_help
+        return cls((key, unescape_zsh_description(description)) for key, description in option_help.items())
+
+    def to_json_object(self):
+        return [self.program_name, [[key, description] for key, description in self.descriptions.items()]]
+
+    @classmethod
+    def from_json_object(cls, json_object):
+        program_name, descriptions = json_object
+        return cls(descriptions, program_name)
+
+
+def dump_params(param_tree, option_help):
+    """Serializes the results of parse_params to a compact JSON string"""
+    return json.dumps({"version": SERIALIZATION_FORMAT_VERSION,
+                       "tree": param_tree.to_json_object(),
+                       "option_help": HelpIndex.from_option_help(option_help).to_json_object()},
+                      separators=(",", ":"))
+
+
+def load_params(serialized):
+    """Returns the (param_tree, option_help) serialized by dump_params"""
+    data = json.loads(serialized)
+    if data.get("version") != SERIALIZATION_FORMAT_VERSION:
+        raise DocoptCompletionException("Unsupported serialization format version {0}".format(data.get("version")))
+    return CommandParams.from_json_object(data["tree"]), HelpIndex.from_json_object(data["option_help"])
+
+
+class SharedSubtrees(object):
+    """Finds the subcommands of a CommandParams tree whose completion sections would be identical, so that the section
+    is emitted once and referenced by all of them.
+
+    get_key(path, param_tree, child_keys) returns everything the section of a node renders apart from its name,
+    given the keys of the node's children. Every node is shared with the first node of the walk that has the same key.
+    The keys are numbered as they are found, so comparing them doesn't depend on the size of the subtrees"""
+    def __init__(self, param_tree, get_key, path=(), get_subcommands=None):
+        nodes = list(param_tree.walk(path, get_subcommands))
+        key_numbers = {}
+        node_keys = {}
+        # children come after their parents in the walk, so the keys are computed from the end
+        for node_path, node in reversed(nodes):
+            subcommands = node.subcommands if get_subcommands is None else get_subcommands(node)
+            child_keys = tuple(node_keys[node_path + (subcommand_name,)] for subcommand_name in subcommands)
+            node_keys[node_path] = key_numbers.setdefault(get_key(node_path, node, child_keys), len(key_numbers))
+        first_paths = {}
+        self.canonical_paths = {}
+        for node_path, _ in nodes:
+            self.canonical_paths[node_path] = first_paths.setdefault(node_keys[node_path], node_path)
+        self.nodes = [(node_path, node) for node_path, node in nodes if self.canonical_paths[node_path] == node_path]
+
+    def get_canonical_path(self, path):
+        """Returns the path of the node whose section is used for the node at path"""
+        return self.canonical_paths[path]
+
+    def is_canonical(self, path):
+        return self.canonical_paths[path] == path
+
+    def iter_canonical(self):
+        """Yields (path, CommandParams) of the nodes whose sections are emitted, in the walk order"""
+        return iter(self.nodes)
+
+
+class SharedFragments(object):
+    """Names the fragments of a completion file (like word lists) that occur more than once, so they can be defined
+    once and referenced. name_template is formatted with the number of the fragment. Fragments shorter than
+    min_length are not shared, since referencing them takes about as much space as repeating them"""
+    def __init__(self, fragments, name_template, min_length=0):
+        counts = {}
+        order = []
+        for fragment in fragments:
+            if fragment not in counts:
+                counts[fragment] = 0
+                order.append(fragment)
+            counts[fragment] += 1
+        self.names = {}
+        for fragment in order:
+            if counts[fragment] > 1 and len(fragment) >= min_length:
+                self.names[fragment] = name_template.format(len(self.names))
+        self.definitions = [(self.names[fragment], fragment) for fragment in order if fragment in self.names]
+
+    def get_name(self, fragment):
+        """Returns the name of a shared fragment, or None if it isn't shared"""
+        return self.names.get(fragment)
+
+
+def group_by_function(subcommands, functions):
+    """Returns a list of (function, subcommand names) of the subcommands that share the same function,
+    in the order of their first subcommand"""
+    groups = {}
+    order = []
+    for subcommand in subcommands:
+        function = functions[subcommand]
+        if function not in groups:
+            groups[function] = []
+            order.append(function)
+        groups[function].append(subcommand)
+    return [(function, groups[function]) for function in order]
+
+
+class WriteReport(object):
+    """Counts the completion files that were written, left unchanged or skipped during a run"""
+    def __init__(self):
+        self.written = 0
+        self.unchanged = 0
+        self.skipped = 0
+
+    def add(self, status):
+        setattr(self, status, getattr(self, status) + 1)
+
+    def __str__(self):
+        return "{0} written, {1} unchanged, {2} skipped".format(self.written, self.unchanged, self.skipped)
+
+
+WRITTEN = "written"
+UNCHANGED = "unchanged"
+SKIPPED = "skipped"
+
+
+def _read_umask():
+    # os.umask can only be read by setting it, which changes it for the whole process. it's read once, at import,
+    # so files created by other threads while it's set can't get the wrong mode
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = _read_umask()
+
+
+COPY_BLOCK_SIZE = 64 * 1024
+
+STRING_TYPES = (type(""), type(u""))
+
+
+class IncrementalFileWriter(object):
+    """A file-like object that replaces a file atomically, only if the written content differs from it.
+
+    The written content is compared with the existing file as it arrives. At the first difference, the matching
+    part is copied to a temporary file in the same directory and the rest is written after it. finish() renames the
+    temporary file over the target, so the target is never left half-written, and it keeps the mode of the file it
+    replaces. If the content turns out identical, no temporary file is created and the target isn't touched at all.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.size = 0
+        self.matched_size = 0
+        self.temp_file = None
+        self.temp_path = None
+        try:
+            self.existing_file = open(file_path, "rb")
+        except (IOError, OSError):
+            self.existing_file = None
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.size += len(data)
+        if self.temp_file is None:
+            if self.existing_file is not None and self.existing_file.read(len(data)) == data:
+                self.matched_size += len(data)
+                return
+            self._start_temp_file()
+        self.temp_file.write(data)
+
+    def _start_temp_file(self):
+        try:
+            mode = os.stat(self.file_path).st_mode & 0o777
+        except OSError:
+            mode = 0o666 & ~UMASK
+        import tempfile
+        dirname, basename = os.path.split(self.file_path)
+        fd, self.temp_path = tempfile.mkstemp(dir=dirname, prefix=".{0}.".format(basename), suffix=".tmp")
+        self.temp_file = os.fdopen(fd, "wb")
+        os.chmod(self.temp_path, mode)
+        if self.existing_file is None:
+            return
+        self.existing_file.seek(0)
+        remaining = self.matched_size
+        while remaining > 0:
+            block = self.existing_file.read(min(remaining, COPY_BLOCK_SIZE))
+            self.temp_file.write(block)
+            remaining -= len(block)
+
+    def finish(self):
+        """Returns WRITTEN if the file was replaced, or UNCHANGED"""
+        if self.temp_file is None and self.existing_file is not None and not self.existing_file.read(1):
+            self.existing_file.close()
+            return UNCHANGED
+        if self.temp_file is None:
+            # the existing file is longer than the new content, or there is no existing file
+            self._start_temp_file()
+        self.temp_file.close()
+        os.rename(self.temp_path, self.file_path)
+        if self.existing_file is not None:
+            self.existing_file.close()
+        return WRITTEN
+
+    def abort(self):
+        if self.existing_file is not None:
+            self.existing_file.close()
+        if self.temp_file is not None:
+            self.temp_file.close()
+            os.remove(self.temp_path)
+
+
 class CompletionGenerator(object):
     """Completion file generator base class. """
 
     def _write_to_file(self, file_path, completion_file_content):
+        # completion_file_content is either a string or an iterable of strings, which are written as they come.
+        # returns the status of the file and the number of bytes in the content
+        dirname = os.path.dirname(file_path)
+        if not os.path.exists(dirname) and os.access(os.path.dirname(dirname), os.W_OK):
+            # like oh-my-zsh's completions directory, or the subdirectory of auxiliary files
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
         if not os.access(os.path.dirname(file_path), os.W_OK):
             print("Skipping file {file_path}, no permissions".format(file_path=file_path))
-            return
+            return SKIPPED, 0
+        if isinstance(completion_file_content, STRING_TYPES):
+            completion_file_content = [completion_file_content]
+        writer = IncrementalFileWriter(file_path)
         try:
-            with open(file_path, "w") as fd:
-                fd.write(completion_file_content)
-        except IOError:
+            for chunk in completion_file_content:
+                writer.write(chunk)
+            status = writer.finish()
+        except (IOError, OSError):
+            writer.abort()
             print("Failed to write {file_path}".format(file_path=file_path))
-            return
-        print("Completion file written to {file_path}".format(file_path=file_path))
+            return SKIPPED, 0
+        except:
+            writer.abort()
+            raise
+        if status == UNCHANGED:
+            print("Completion file {file_path} is up to date".format(file_path=file_path))
+        else:
+            print("Completion file written to {file_path}".format(file_path=file_path))
+        return status, writer.size
 
     def get_name(self):
         raise NotImplementedError()
@@ -143,13 +582,51 @@ class CompletionGenerator(object):
     def get_completion_file_content(self, cmd, param_tree, option_help):
         raise NotImplementedError()
 
+    def iter_completion_file_content(self, cmd, param_tree, option_help):
+        """Yields the completion file content in chunks, so it can be written without holding all of it in memory.
+        Generators for large command trees override this, and get_completion_file_content joins the chunks"""
+        yield self.get_completion_file_content(cmd, param_tree, option_help)
+
+    def write_completion_file(self, fd, cmd, param_tree, option_help):
+        """Writes the completion file content to a file-like object"""
+        for chunk in self.iter_completion_file_content(cmd, param_tree, option_help):
+            fd.write(chunk)
+
+    def get_auxiliary_files(self, cmd, param_tree, option_help):
+        """Returns a list of (relative path, content) of files to write next to the completion file.
+        Generators that split their output into several files override this"""
+        return []
+
+    def iter_auxiliary_files(self, cmd, param_tree, option_help):
+        """Yields (relative path, iterable of content chunks) of the auxiliary files"""
+        for relative_path, content in self.get_auxiliary_files(cmd, param_tree, option_help):
+            yield relative_path, [content]
+
+    def get_completion_dirs(self):
+        """Returns the CompletionDirs that finds the completion directories, probing each of them only once"""
+        from .discovery import get_completion_dirs
+        return get_completion_dirs()
+
     def completion_path_exists(self):
-        return os.path.exists(self.get_completion_path())
+        return self.get_completion_dirs().isdir(self.get_completion_path())
 
-    def generate(self, cmd, param_tree, option_help):
-        completion_file_content = self.get_completion_file_content(cmd, param_tree, option_help)
+    def generate(self, cmd, param_tree, option_help, report=None):
+        # returns a list of (file path, status) of the files that were handled
+        # the content is rendered while it is written, separately for every completion path
+        results = []
         file_paths = self.get_completion_filepath(cmd)
         if not isinstance(file_paths, types.GeneratorType):
             file_paths = [file_paths]
         for file_path in file_paths:
-            self._write_to_file(file_path, completion_file_content)
+            files = [(file_path, self.iter_completion_file_content(cmd, param_tree, option_help))]
+            files.extend((os.path.join(os.path.dirname(file_path), relative_path), content)
+                         for relative_path, content in self.iter_auxiliary_files(cmd, param_tree, option_help))
+            for path, content in files:
+                with phase("render_and_write.{0}".format(type(self).__name__)) as details:
+                    status, size = self._write_to_file(path, content)
+                    details[status] = 1
+                    details["bytes"] = size
+                results.append((path, status))
+                if report is not None:
+                    report.add(status)
+        return results
@@ -0,0 +1,282 @@
+"""A local daemon that completes the values of positional arguments, such as host names or volume names.
+
+Completion files generated with --dynamic-values ask the daemon for the values of the argument being completed,
+over a Unix socket, and fall back to the regular completion when it isn't running. The values come from providers,
+which are configured in a JSON file or registered by other packages under the "docopt_completion.providers" entry
+point group, and are cached for the provider's ttl.
+
+The protocol is a single request line, "<command>\\t<subcommand path>\\t<argument>\\t<prefix>\\n", answered by the
+values that start with the prefix, one per line. The daemon closes the connection after answering.
+"""
+from __future__ import print_function
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    # python 2
+    import SocketServer as socketserver
+
+from .common import DocoptCompletionException
+from .process import clock, run_process
+
+DEFAULT_TTL = 60
+DEFAULT_PROVIDER_TIMEOUT = 5
+DEFAULT_CLIENT_TIMEOUT = 1
+
+MAX_REQUEST_SIZE = 64 * 1024
+
+SOCKET_ENV_VAR = "DOCOPT_COMPLETION_SOCKET"
+
+ENTRY_POINT_GROUP = "docopt_completion.providers"
+
+
+def get_default_socket_path():
+    """The socket path used by the daemon and the generated completion files, unless $DOCOPT_COMPLETION_SOCKET is set"""
+    if os.environ.get(SOCKET_ENV_VAR):
+        return os.environ[SOCKET_ENV_VAR]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "docopt-completion.sock")
+    return "/tmp/docopt-completion-{0}.sock".format(os.getuid())
+
+
+class ValueProvider(object):
+    """Provides the values of an argument.
+
+    command, path and argument restrict the provider to a command name, a subcommand path (a tuple of subcommand
+    names) and an argument name (like "<host>"). Any of them can be None to match everything.
+    The values are cached for ttl seconds."""
+    def __init__(self, command=None, path=None, argument=None, ttl=DEFAULT_TTL):
+        self.command = command
+        self.path = tuple(path) if path is not None else None
+        self.argument = argument
+        self.ttl = ttl
+
+    def matches(self, command, path, argument):
+        return ((self.command is None or self.command == command) and
+                (self.path is None or self.path == path) and
+                (self.argument is None or self.argument == argument))
+
+    def get_values(self, command, path, argument):
+        raise NotImplementedError()
+
+
+class StaticValueProvider(ValueProvider):
+    def __init__(self, values, **kwargs):
+        super(StaticValueProvider, self).__init__(**kwargs)
+        self.values = list(values)
+
+    def get_values(self, command, path, argument):
+        return self.values
+
+
+class CommandValueProvider(ValueProvider):
+    """Runs a command and provides the lines of its output"""
+    def __init__(self, argv, timeout=DEFAULT_PROVIDER_TIMEOUT, **kwargs):
+        super(CommandValueProvider, self).__init__(**kwargs)
+        self.argv = argv
+        self.timeout = timeout
+
+    def get_values(self, command, path, argument):
+        returncode, output = run_process(self.argv, self.timeout)
+        if returncode is None:
+            raise DocoptCompletionException("{0} did not finish within {1} seconds".format(" ".join(self.argv),
+                                                                                            self.timeout))
+        if returncode != 0:
+            raise DocoptCompletionException("{0} returned {1}".format(" ".join(self.argv), returncode))
+        return [line.strip() for line in output.decode("utf-8", "replace").splitlines() if line.strip()]
+
+
+def create_provider(config):
+    """Creates a provider from a configuration dict. The values are given either as a list ("values"),
+    or as a command whose output lines are the values ("exec")"""
+    kwargs = dict((key, config[key]) for key in ("command", "argument", "ttl") if key in config)
+    if "path" in config:
+        kwargs["path"] = config["path"].split()
+    if "values" in config:
+        return StaticValueProvider(config["values"], **kwargs)
+    if "exec" in config:
+        argv = config["exec"].split() if isinstance(config["exec"], type(u"")) else config["exec"]
+        return CommandValueProvider(argv, config.get("timeout", DEFAULT_PROVIDER_TIMEOUT), **kwargs)
+    raise ValueError("A provider needs either 'values' or 'exec': {0!r}".format(config))
+
+
+def load_providers_config(config_path):
+    """Reads a JSON list of provider configurations, see create_provider"""
+    with open(config_path) as fd:
+        return [create_provider(config) for config in json.load(fd)]
+
+
+def load_entry_point_providers():
+    """Returns the providers registered by installed packages. Every entry point is a callable that returns
+    a list of ValueProvider instances"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        group = list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+    else:
+        all_entry_points = entry_points()
+        if hasattr(all_entry_points, "select"):
+            group = list(all_entry_points.select(group=ENTRY_POINT_GROUP))
+        else:
+            group = list(all_entry_points.get(ENTRY_POINT_GROUP, []))
+    providers = []
+    for entry_point in group:
+        providers.extend(entry_point.load()())
+    return providers
+
+
+class ValueResolver(object):
+    """Finds the provider of an argument and caches its values for the provider's ttl"""
+    def __init__(self, providers):
+        self.providers = list(providers)
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def _get_provider(self, command, path, argument):
+        for provider in self.providers:
+            if provider.matches(command, path, argument):
+                return provider
+        return None
+
+    def get_values(self, command, path, argument, prefix=""):
+        provider = self._get_provider(command, path, argument)
+        if provider is None:
+            return []
+        key = (id(provider), command, path, argument)
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None and entry[0] > clock():
+            values = entry[1]
+        else:
+            try:
+                values = list(provider.get_values(command, path, argument))
+            except Exception as e:
+                print("Provider of {0} {1} failed: {2}".format(command, argument, e), file=sys.stderr)
+                return []
+            with self.lock:
+                self.cache[key] = (clock() + provider.ttl, values)
+        return [value for value in values if value.startswith(prefix)]
+
+
+def parse_request(line):
+    """Returns the (command, path, argument, prefix) of a request line"""
+    fields = line.rstrip("\r\n").split("\t")
+    if len(fields) < 3:
+        raise ValueError("Invalid request: {0!r}".format(line))
+    command, path, argument = fields[:3]
+    prefix = fields[3] if len(fields) > 3 else ""
+    return command, tuple(path.split()), argument, prefix
+
+
+def format_request(command, path, argument, prefix=""):
+    return "\t".join([command, " ".join(path), argument, prefix]) + "\n"
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_SIZE).decode("utf-8", "replace")
+        try:
+            command, path, argument, prefix = parse_request(line)
+        except ValueError:
+            return
+        values = self.server.resolver.get_values(command, path, argument, prefix)
+        self.wfile.write("".join(value + "\n" for value in values).encode("utf-8"))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _is_socket_alive(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error:
+        return False
+    finally:
+        client.close()
+    return True
+
+
+class CompletionDaemon(object):
+    """Serves the values of a ValueResolver on a Unix socket, which only the current user can connect to"""
+    def __init__(self, resolver, socket_path=None):
+        self.resolver = resolver
+        self.socket_path = socket_path or get_default_socket_path()
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            if _is_socket_alive(self.socket_path):
+                raise socket.error("Another daemon is listening on {0}".format(self.socket_path))
+            # left behind by a daemon that was killed
+            os.remove(self.socket_path)
+        old_umask = os.umask(0o077)
+        try:
+            self.server = _Server(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.resolver = self.resolver
+
+    def serve_forever(self):
+        if self.server is None:
+            self.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.server_close()
+        self.server = None
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+
+def query(command, path, argument, prefix="", socket_path=None, timeout=DEFAULT_CLIENT_TIMEOUT):
+    """Asks a running daemon for the values of an argument. Returns None if the daemon can't be reached"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path or get_default_socket_path())
+        client.sendall(format_request(command, path, argument, prefix).encode("utf-8"))
+        chunks = []
+        while True:
+            chunk = client.recv(MAX_REQUEST_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        client.close()
+    return b"".join(chunks).decode("utf-8").splitlines()
+
+
+def run_daemon(socket_path=None, providers_config=None):
+    providers = load_providers_config(providers_config) if providers_config else []
+    providers += load_entry_point_providers()
+    daemon = CompletionDaemon(ValueResolver(providers), socket_path)
+    daemon.start()
+    print("Serving {0} value providers on {1}".format(len(providers), daemon.socket_path))
+    # exit cleanly on SIGTERM too, so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
@@ -0,0 +1,127 @@
+"""Finds the directories that completion files are installed to.
+
+The filesystem is probed once per run: every directory is checked once, and zsh is asked for its $fpath once,
+no matter how many generators and scripts ask. The results are shared by all the generators of a batch run.
+"""
+import os
+import threading
+from .process import run_process
+from .stats import phase
+
+ZSH_PREFIXES = [os.path.join(os.path.sep, "usr"),
+                os.path.join(os.path.sep, "usr", "local"),
+                os.path.join(os.path.sep, "opt", "freeware"),
+                os.path.join(os.path.sep, "opt", "csw")]
+ZSH_INFIXES = ["site", "vendor"]
+ZSH_SUFFIXES = ["completions", "functions"]
+
+# the $fpath directories that are meant for completion files of other packages, rather than zsh's own functions
+ZSH_SITE_DIR_NAMES = frozenset("{0}-{1}".format(infix, suffix) for infix in ZSH_INFIXES for suffix in ZSH_SUFFIXES)
+
+ZSH_QUERY_TIMEOUT = 5
+
+
+class CompletionDirs(object):
+    """The completion directories of this host, probed lazily and only once.
+    environ defaults to os.environ, and zsh is the zsh executable asked for $fpath when $FPATH isn't set"""
+    def __init__(self, environ=None, zsh="zsh"):
+        self.environ = os.environ if environ is None else environ
+        self.zsh = zsh
+        self.lock = threading.RLock()
+        self.directories = {}
+        self.results = {}
+
+    def isdir(self, path):
+        with self.lock:
+            if path not in self.directories:
+                self.directories[path] = os.path.isdir(path)
+            return self.directories[path]
+
+    def _get(self, name, func):
+        with self.lock:
+            if name not in self.results:
+                with phase("discovery.{0}".format(name)):
+                    self.results[name] = func()
+            return self.results[name]
+
+    def _get_home(self):
+        return os.path.expanduser("~")
+
+    def get_fpath(self):
+        """Returns zsh's function search path, from $FPATH or by asking zsh. Empty if zsh isn't installed"""
+        return self._get("fpath", self._find_fpath)
+
+    def _find_fpath(self):
+        if self.environ.get("FPATH"):
+            return [path for path in self.environ["FPATH"].split(os.pathsep) if path]
+        try:
+            returncode, output = run_process([self.zsh, "-fc", "print -rl -- $fpath"], ZSH_QUERY_TIMEOUT)
+        except OSError:
+            return []
+        if returncode != 0:
+            return []
+        return [path for path in output.decode("utf-8", "replace").splitlines() if path]
+
+    def get_zsh_site_dirs(self):
+        """Returns the existing site and vendor completion directories of zsh: the known locations under /usr,
+        /usr/local, /opt/freeware and /opt/csw, and the site and vendor directories in $fpath (such as Homebrew's)"""
+        return self._get("zsh_site_dirs", self._find_zsh_site_dirs)
+
+    def _find_zsh_site_dirs(self):
+        candidates = [os.path.join(prefix, "share", "zsh", "{0}-{1}".format(infix, suffix))
+                      for prefix in ZSH_PREFIXES for infix in ZSH_INFIXES for suffix in ZSH_SUFFIXES]
+        candidates += [path for path in self.get_fpath() if os.path.basename(path.rstrip(os.sep)) in ZSH_SITE_DIR_NAMES]
+        paths = []
+        real_paths = set()
+        for path in candidates:
+            if not self.isdir(path):
+                continue
+            # the same directory may be reached through a symlink, or be listed twice
+            real_path = os.path.realpath(path)
+            if real_path not in real_paths:
+                real_paths.add(real_path)
+                paths.append(path)
+        return paths
+
+    def get_oh_my_zsh_dir(self):
+        return self.environ.get("ZSH") or os.path.join(self._get_home(), ".oh-my-zsh")
+
+    def get_prezto_dir(self):
+        return os.path.join(self.environ.get("ZDOTDIR") or self._get_home(), ".zprezto")
+
+    def get_bash_completion_dirs(self):
+        """Returns the existing directories of bash-completion's on-demand loader, in the order it searches them:
+        $BASH_COMPLETION_USER_DIR/completions (or $XDG_DATA_HOME/bash-completion/completions), and
+        bash-completion/completions under every $XDG_DATA_DIRS directory"""
+        return self._get("bash_completion_dirs", self._find_bash_completion_dirs)
+
+    def _find_bash_completion_dirs(self):
+        user_dir = self.environ.get("BASH_COMPLETION_USER_DIR")
+        if not user_dir:
+            data_home = self.environ.get("XDG_DATA_HOME") or os.path.join(self._get_home(), ".local", "share")
+            user_dir = os.path.join(data_home, "bash-completion")
+        candidates = [os.path.join(user_dir, "completions")]
+        data_dirs = self.environ.get("XDG_DATA_DIRS") or "/usr/local/share:/usr/share"
+        candidates += [os.path.join(data_dir, "bash-completion", "completions")
+                       for data_dir in data_dirs.split(os.pathsep) if data_dir]
+        return [path for path in candidates if self.isdir(path)]
+
+
+_completion_dirs = None
+_completion_dirs_lock = threading.Lock()
+
+
+def get_completion_dirs():
+    """Returns the CompletionDirs shared by all the generators of this run"""
+    global _completion_dirs
+    with _completion_dirs_lock:
+        if _completion_dirs is None:
+            _completion_dirs = CompletionDirs()
+        return _completion_dirs
+
+
+def reset_completion_dirs():
+    """Forgets the probed directories, so they are probed again. For long-running processes"""
+    global _completion_dirs
+    with _completion_dirs_lock:
+        _completion_dirs = None
@@ -2,18 +2,69 @@ from __future__ import print_function
 import sys
 import os
 import docopt
-from .bash import BashCompletion, ManualBashCompletion
-from .zsh import OhMyZshCompletion, ZshPreztoCompletion, ZshUsrShareCompletion, ZshCompletion
-from .common import DocoptCompletionException, parse_params
+from .common import DocoptCompletionException, WriteReport, parse_params
+from .capture import HelpCapturer, DEFAULT_TIMEOUT, DEFAULT_MAX_OUTPUT_SIZE, DEFAULT_ENCODING
+from .stats import StatsCollector, phase, add_hook, remove_hook
+
+DEFAULT_JOBS = 4
+DEFAULT_WATCH_INTERVAL = 1.0
+DEFAULT_WATCH_DEBOUNCE = 0.5
+
+# the generator modules, the cache and the thread pool are imported only when they are used,
+# since for small scripts importing everything takes longer than generating the completion files
 
 USAGE = """Usage:
-    docopt-completion <docopt-script> [--manual-zsh | --manual-bash]
+    docopt-completion <docopt-script>... [--manual-zsh | --manual-bash] [options]
+    docopt-completion --manifest=<file> [--manual-zsh | --manual-bash] [options]
+    docopt-completion --scan [--manual-zsh | --manual-bash] [options]
+    docopt-completion --daemon [--socket=<path>] [--providers=<file>]
     docopt-completion --help
 
 Options:
-    --manual-zsh        Do not attempt to find completion paths automatically. Output ZSH completion file to local directory
-    --manual-bash       Do not attempt to find completion paths automatically. Output BASH completion file to local directory
-"""
+    --manual-zsh                Do not attempt to find completion paths automatically. Output ZSH completion file to local directory
+    --manual-bash               Do not attempt to find completion paths automatically. Output BASH completion file to local directory
+    --manifest=<file>           Read the docopt scripts from a file, one per line. Empty lines and lines starting with '#' are ignored
+    --scan                      Generate completion files for all the console scripts installed in this Python environment
+                                that use docopt, found without running them
+    --jobs=<n>                  Number of scripts to run and parse concurrently [default: {0}]
+    --no-cache                  Always run the scripts with --help, instead of using the results cached from previous runs
+    --static                    Look for the usage text in the scripts' source code instead of running them. Scripts whose usage
+                                can't be found this way are run with --help
+    --timeout=<seconds>         Kill a script that doesn't finish printing its help within this time [default: {1}]
+    --max-help-size=<bytes>     Kill a script whose help output exceeds this size [default: {2}]
+    --encoding=<encoding>       The encoding of the scripts' help output [default: {3}]
+    --bash-flat                 Generate BASH completion files that use lookup tables instead of a function per subcommand.
+                                Faster for large commands, requires bash 4.2 or later
+    --bash-lazy                 Generate BASH completion files in the bash-completion "completions" directory, which are
+                                loaded on demand rather than at every shell start
+    --bash-split                With --bash-lazy, write each top-level subcommand to a separate file, loaded on demand
+    --bash-descriptions         List the BASH completions with the descriptions of the options and subcommands.
+                                Requires bash 4.2 or later
+    --zsh-autoload              Write each top-level ZSH subcommand to a separate function file, autoloaded on demand
+    --zsh-compile               Compile the ZSH completion files with zcompile
+    --bundle=<path>             Write the completion files of all the scripts to a new staging directory, or to a
+                                .tar, .tar.gz, .tar.bz2, .tar.xz or .zip archive, instead of installing them, and a
+                                manifest of their hashes to <path>.manifest.json. For packaging
+    --shells=<shells>           The shells to write completion files for with --bundle, separated by commas
+                                [default: bash,zsh]
+    --fsync                     With --bundle, sync the written files to disk once they are all written
+    --watch                     Keep running, and regenerate the completion files of the scripts whenever they change.
+                                Directories can be given instead of scripts, to watch the scripts added to them
+    --watch-interval=<seconds>  How often to check the scripts for changes, where inotify isn't available [default: {4}]
+    --watch-debounce=<seconds>  Regenerate only after the scripts stopped changing for this long [default: {5}]
+    --share-fragments           Define the sections, option lists and word lists that several subcommands have in common
+                                once, and refer to them. Makes the files of commands with many similar subcommands
+                                smaller and faster to load. Not used with --bash-flat
+    --dynamic-values            Complete the values of arguments in BASH from the completion daemon, when it is running
+    --daemon                    Run the completion daemon, which answers the values of arguments from value providers
+    --socket=<path>             The Unix socket of the completion daemon. The default is $DOCOPT_COMPLETION_SOCKET, or
+                                docopt-completion.sock in $XDG_RUNTIME_DIR
+    --providers=<file>          A JSON file with the value providers of the completion daemon
+    --stats                     Print the time spent in every phase of the run, and the bytes and nodes handled
+    --stats-json=<file>         Write the phase statistics to a file as JSON
+    --profile=<file>            Profile the run with cProfile and write the profile to a file
+""".format(DEFAULT_JOBS, DEFAULT_TIMEOUT, DEFAULT_MAX_OUTPUT_SIZE, DEFAULT_ENCODING, DEFAULT_WATCH_INTERVAL,
+           DEFAULT_WATCH_DEBOUNCE)
 
 COMPLETION_PATH_USAGE = """No completion paths found.
 docopt-completion only supports the following configurations:
@@ -28,12 +79,23 @@ def _generate_paths_help(generators):
         output += "\t{}. The path {} must exist.\n".format(generator.get_name(), generator.get_completion_path())
     return output
 
-def _autodetect_generators():
-    completion_generators = [OhMyZshCompletion(),
-                             ZshPreztoCompletion(),
-                             ZshUsrShareCompletion(),
-                             BashCompletion()]
-    generators_to_use = [generator for generator in completion_generators if generator.completion_path_exists()]
+def _create_bash_generator(manual, lazy, bash_options=None):
+    from .bash import BashCompletion, ManualBashCompletion, BashLazyCompletion, ManualBashLazyCompletion
+    if lazy:
+        generator_class = ManualBashLazyCompletion if manual else BashLazyCompletion
+    else:
+        generator_class = ManualBashCompletion if manual else BashCompletion
+    return generator_class(**(bash_options or {}))
+
+def _autodetect_generators(bash_lazy=False, bash_options=None, zsh_options=None):
+    from .zsh import OhMyZshCompletion, ZshPreztoCompletion, ZshUsrShareCompletion
+    zsh_options = zsh_options or {}
+    completion_generators = [OhMyZshCompletion(**zsh_options),
+                             ZshPreztoCompletion(**zsh_options),
+                             ZshUsrShareCompletion(**zsh_options),
+                             _create_bash_generator(False, bash_lazy, bash_options)]
+    with phase("autodetect_generators"):
+        generators_to_use = [generator for generator in completion_generators if generator.completion_path_exists()]
 
     if len(generators_to_use) == 0:
         paths_help = _generate_paths_help(completion_generators)
@@ -41,30 +103,275 @@ def _autodetect_generators():
 
     return generators_to_use
 
-def docopt_completion(cmd, manual_zsh=False, manual_bash=False):
+def _get_generators(manual_zsh, manual_bash, bash_lazy=False, bash_options=None, zsh_options=None):
+    # bash_options and zsh_options are the keyword arguments of the bash and zsh generators
     if manual_zsh:
-        generators_to_use = [ZshCompletion()]
+        from .zsh import ZshCompletion
+        return [ZshCompletion(**(zsh_options or {}))]
     elif manual_bash:
-        generators_to_use = [ManualBashCompletion()]
-    else:
-        generators_to_use = _autodetect_generators()
+        return [_create_bash_generator(True, bash_lazy, bash_options)]
+    return _autodetect_generators(bash_lazy, bash_options, zsh_options)
+
+def _get_cache(use_cache):
+    if not use_cache:
+        return None
+    from .cache import UsageCache
+    return UsageCache()
 
-    param_tree, option_help = parse_params(cmd)
+def docopt_completion(cmd, manual_zsh=False, manual_bash=False, use_cache=True, report=None, static=False,
+                      capturer=None, generators=None, usage_index=None):
+    # generators: a list of CompletionGenerator instances to use instead of the default ones
+    generators_to_use = generators or _get_generators(manual_zsh, manual_bash)
+
+    param_tree, option_help = parse_params(cmd, _get_cache(use_cache), static, capturer, usage_index)
 
     for generator in generators_to_use:
-        generator.generate(os.path.basename(cmd), param_tree, option_help)
+        generator.generate(os.path.basename(cmd), param_tree, option_help, report)
+
+def _parse_script(cmd, cache, static, capturer, usage_index):
+    # runs in a worker thread. errors are returned rather than raised, so one broken script
+    # doesn't stop the rest of the batch
+    try:
+        return cmd, parse_params(cmd, cache, static, capturer, usage_index), None
+    except DocoptCompletionException as e:
+        return cmd, None, e.args[0]
+    except docopt.DocoptLanguageError as e:
+        return cmd, None, "Failed to parse the usage of '{cmd}' : {error}".format(cmd=cmd, error=e)
+    except Exception as e:
+        return cmd, None, "Failed to handle '{cmd}' : {error!r}".format(cmd=cmd, error=e)
+
+def _generate_script(cmd, params, generators, report):
+    try:
+        param_tree, option_help = params
+        for generator in generators:
+            generator.generate(os.path.basename(cmd), param_tree, option_help, report)
+    except DocoptCompletionException as e:
+        return e.args[0]
+    except Exception as e:
+        return "Failed to write the completion files of '{cmd}' : {error!r}".format(cmd=cmd, error=e)
+    return None
+
+def docopt_completion_batch(cmds, manual_zsh=False, manual_bash=False, jobs=DEFAULT_JOBS, use_cache=True,
+                            report=None, static=False, capturer=None, generators=None, usage_index=None):
+    """Generate completion files for several docopt scripts.
+
+    The scripts are run and parsed on a pool of worker threads, while the completion files are written
+    by the calling thread in the order the scripts were given. usage_index is an EnvironmentIndex of
+    console scripts whose usage texts are known without running them.
+    Returns a list of (cmd, error) tuples, where error is None for scripts that succeeded.
+    """
+    from multiprocessing.pool import ThreadPool
+    generators_to_use = generators or _get_generators(manual_zsh, manual_bash)
+    cache = _get_cache(use_cache)
+    results = []
+    if not cmds:
+        return results
+    pool = ThreadPool(max(1, min(jobs, len(cmds))))
+    try:
+        parse = lambda cmd: _parse_script(cmd, cache, static, capturer, usage_index)
+        for cmd, params, error in pool.imap(parse, cmds):
+            if error is None:
+                error = _generate_script(cmd, params, generators_to_use, report)
+            results.append((cmd, error))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path) as fd:
+            lines = [line.strip() for line in fd]
+    except IOError:
+        raise DocoptCompletionException("Failed to read manifest file {0}".format(manifest_path))
+    return [line for line in lines if line and not line.startswith("#")]
+
+def _print_batch_report(results):
+    failures = [(cmd, error) for cmd, error in results if error is not None]
+    for cmd, error in failures:
+        print("Failed to generate completion for {cmd}: {error}".format(cmd=cmd, error=error))
+    print("{0} succeeded, {1} failed".format(len(results) - len(failures), len(failures)))
+    return len(failures) == 0
+
+def _get_generator_options(arguments):
+    bash_lazy = arguments["--bash-lazy"]
+    bash_options = dict(flat=arguments["--bash-flat"], descriptions=arguments["--bash-descriptions"],
+                        dynamic_values=arguments["--dynamic-values"], share_fragments=arguments["--share-fragments"])
+    if bash_lazy:
+        bash_options.update(split=arguments["--bash-split"])
+    zsh_options = dict(autoload=arguments["--zsh-autoload"], zcompile=arguments["--zsh-compile"],
+                       share_fragments=arguments["--share-fragments"])
+    return bash_lazy, bash_options, zsh_options
 
 def main():
     arguments = docopt.docopt(USAGE)
-    cmd = arguments["<docopt-script>"]
+    collector = StatsCollector() if arguments["--stats"] or arguments["--stats-json"] else None
+    profiler = None
+    if arguments["--profile"]:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if collector is not None:
+            add_hook(collector)
+        if profiler is not None:
+            profiler.enable()
+        return _run(arguments)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(arguments["--profile"])
+        if collector is not None:
+            remove_hook(collector)
+            _write_stats(collector, arguments["--stats"], arguments["--stats-json"])
+
+def _write_stats(collector, print_stats, json_path):
+    if print_stats:
+        print(collector.format())
+    if json_path:
+        import json
+        with open(json_path, "w") as fd:
+            json.dump(collector.to_dict(), fd, indent=2, sort_keys=True)
+
+def _run_daemon(arguments):
+    from .daemon import run_daemon
+    try:
+        return run_daemon(arguments["--socket"], arguments["--providers"])
+    except (IOError, OSError, ValueError) as e:
+        print("Failed to run the completion daemon: {0}".format(e))
+        return 1
+
+def _watch(cmds, generators, jobs, use_cache, static, capturer, interval, debounce, usage_index=None):
+    import signal
+    from .cache import resolve_executable
+    from .discovery import reset_completion_dirs
+    from .watch import ScriptWatcher, watch
+    directories = [cmd for cmd in cmds if os.path.isdir(cmd)]
+    scripts = {}
+    for cmd in cmds:
+        if cmd in directories:
+            continue
+        path = resolve_executable(cmd)
+        if path is None:
+            raise DocoptCompletionException("Failed to find {0}".format(cmd))
+        scripts[path] = cmd
+
+    def regenerate(changed_cmds):
+        # directories that were created since the last time may be used now
+        reset_completion_dirs()
+        report = WriteReport()
+        results = docopt_completion_batch(changed_cmds, jobs=jobs, use_cache=use_cache, report=report, static=static,
+                                          capturer=capturer, generators=generators, usage_index=usage_index)
+        print("Completion files: {0}".format(report))
+        _print_batch_report(results)
+        sys.stdout.flush()
+
+    def rescan_and_regenerate(changed_cmds):
+        # a script is rewritten when its distribution is reinstalled, so the modules that changed are read again
+        usage_index.scan()
+        if use_cache:
+            usage_index.save()
+        regenerate(changed_cmds)
+
+    # the watcher takes its first snapshot before the initial generation, so changes made meanwhile aren't missed
+    watcher = ScriptWatcher(scripts, directories)
+    if scripts:
+        regenerate([cmd for cmd in cmds if cmd not in directories])
+    print("Watching {0} scripts and {1} directories".format(len(scripts), len(directories)))
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        watch(watcher, regenerate if usage_index is None else rescan_and_regenerate, interval, debounce)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def _scan(use_index):
+    from .scan import scan_environment
+    index = scan_environment(use_index=use_index)
+    cmds = index.get_docopt_scripts()
+    print("Found {0} docopt scripts in {1} distributions".format(len(cmds), len(index.distributions)))
+    return cmds, index
+
+def _open_bundle(arguments, bash_options, zsh_options):
+    from .bundle import open_bundle, get_bundle_generators
+    shells = [shell.strip() for shell in arguments["--shells"].split(",") if shell.strip()]
+    bundle = open_bundle(arguments["--bundle"], arguments["--fsync"])
+    try:
+        # the bash files are always for bash-completion's on-demand loader
+        bash_options = dict(bash_options, split=arguments["--bash-split"])
+        return bundle, get_bundle_generators(bundle, shells, bash_options, zsh_options)
+    except:
+        bundle.abort()
+        raise
+
+def _run_with_bundle(arguments, run):
+    # run gets the generators, and the bundle is closed only if it succeeds for all the scripts. otherwise the bundle
+    # is discarded, so an incomplete bundle is never shipped
+    _, bash_options, zsh_options = _get_generator_options(arguments)
+    try:
+        bundle, generators = _open_bundle(arguments, bash_options, zsh_options)
+    except (IOError, OSError) as e:
+        raise DocoptCompletionException("Failed to create the bundle {0}: {1}".format(arguments["--bundle"], e))
+    try:
+        result = run(generators)
+        if result != 0:
+            bundle.abort()
+            print("Bundle {0} discarded, since not all the scripts succeeded".format(arguments["--bundle"]))
+            return result
+        bundle.close()
+    except:
+        bundle.abort()
+        raise
+    print("Bundle written to {0}: {1} files".format(arguments["--bundle"], len(bundle.files)))
+    return result
+
+def _run(arguments):
+    if arguments["--daemon"]:
+        return _run_daemon(arguments)
     manual_bash = arguments["--manual-bash"]
     manual_zsh = arguments["--manual-zsh"]
+    use_cache = not arguments["--no-cache"]
+    report = WriteReport()
+    static = arguments["--static"]
+    try:
+        jobs = int(arguments["--jobs"])
+        capturer = HelpCapturer(float(arguments["--timeout"]), int(arguments["--max-help-size"]),
+                                arguments["--encoding"])
+        watch_interval = float(arguments["--watch-interval"])
+        watch_debounce = float(arguments["--watch-debounce"])
+    except ValueError:
+        print("--jobs, --timeout, --max-help-size, --watch-interval and --watch-debounce must be numbers")
+        return 1
     try:
-        docopt_completion(cmd, manual_zsh, manual_bash)
+        usage_index = None
+        if arguments["--scan"]:
+            cmds, usage_index = _scan(use_cache)
+        elif arguments["--manifest"]:
+            cmds = _read_manifest(arguments["--manifest"])
+        else:
+            cmds = arguments["<docopt-script>"]
+        run = lambda generators: _generate(cmds, generators, jobs, use_cache, report, static, capturer, usage_index)
+        if arguments["--bundle"]:
+            return _run_with_bundle(arguments, run)
+        generators = _get_generators(manual_zsh, manual_bash, *_get_generator_options(arguments))
+        if arguments["--watch"]:
+            return _watch(cmds, generators, jobs, use_cache, static, capturer, watch_interval, watch_debounce,
+                          usage_index)
+        return run(generators)
     except DocoptCompletionException as e:
         print(e.args[0])
         return 1
-    return 0
+
+def _generate(cmds, generators, jobs, use_cache, report, static, capturer, usage_index):
+    if len(cmds) == 1:
+        docopt_completion(cmds[0], use_cache=use_cache, report=report, static=static, capturer=capturer,
+                          generators=generators, usage_index=usage_index)
+        print("Completion files: {0}".format(report))
+        return 0
+    results = docopt_completion_batch(cmds, jobs=jobs, use_cache=use_cache, report=report, static=static,
+                                      capturer=capturer, generators=generators, usage_index=usage_index)
+    print("Completion files: {0}".format(report))
+    return 0 if _print_batch_report(results) else 1
 
 if __name__ == "__main__":
     sys.exit(main())
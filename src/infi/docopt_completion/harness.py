@@ -0,0 +1,363 @@
+"""Checks the candidates that the generated completion scripts suggest for every subcommand of a command, and how long
+every completion takes. Run with "python -m infi.docopt_completion.harness".
+
+For every subcommand path of the command tree, the generated script is completed in the shell with the word after
+the path empty and with "-", and the candidates are compared with the subcommands and options of the path.
+Only the bash generators are checked: the completion function is called directly with COMP_WORDS and COMP_CWORD set.
+The completions run in an empty directory, so no file names are suggested.
+
+Usage:
+    harness [options] [<script>]
+
+Options:
+    --usage=<file>          Read the usage text from a file instead of running the script with --help
+    --fanout=<n>            Without a script or a usage file, the synthetic usage text of the benchmark is checked,
+                            with this number of subcommands for every command [default: 3]
+    --depth=<n>             Number of subcommand levels of the synthetic usage text [default: 2]
+    --options=<n>           Number of options in every usage line of the synthetic usage text [default: 3]
+    --arguments=<n>         Number of positional arguments in every usage line of the synthetic usage text
+                            [default: 1]
+    --generators=<names>    The generators to check, separated by commas (see the benchmark) [default: all]
+    --repeat=<n>            Number of completions to average in every latency measurement [default: 10]
+    --output=<file>         Write the results to a file instead of the standard output
+    --baseline=<file>       Compare the results with the results of a previous run. Only wrong candidates that were
+                            right in the baseline, and completions that got slower, fail the run
+    --threshold=<ratio>     A completion is slower than in the baseline if it takes this many times longer and
+                            at least {0}us more [default: 1.5]
+"""
+from __future__ import print_function
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+HARNESS_FORMAT_VERSION = 1
+
+# shorter differences are noise, however large the ratio is
+LATENCY_NOISE_USEC = 100
+
+# a shell that takes longer than this to run all the completions of a generator is killed
+SHELL_TIMEOUT = 600
+
+RECORD_SEPARATOR = "\x1e"
+
+# sources a generated completion file, and runs every state (written below it) with _harness_state.
+# the completion function is the one registered for the command with "complete -F".
+# for every state, prints a record separator with the state index and the average completion time in microseconds,
+# followed by the candidates, one per line
+BASH_DRIVER_TEMPLATE = """
+_harness_usec() {{ local t=${{EPOCHREALTIME/[.,]/}}; echo $((10#$t)); }}
+source {script} || exit 3
+_harness_function=$(complete -p {cmd} 2>/dev/null)
+_harness_function=${{_harness_function##*-F }}
+_harness_function=${{_harness_function%% *}}
+[[ -n $_harness_function ]] || exit 3
+
+_harness_state()
+{{
+    local index=$1 start end i
+    shift
+    COMP_WORDS=("$@")
+    COMP_CWORD=$(( $# - 1 ))
+    COMP_LINE="$*"
+    COMP_POINT=${{#COMP_LINE}}
+    start=$(_harness_usec)
+    for (( i = 0; i < {repeat}; i++ )); do
+        COMPREPLY=()
+        $_harness_function {cmd} "${{COMP_WORDS[COMP_CWORD]}}" "${{COMP_WORDS[COMP_CWORD-1]}}"
+    done
+    end=$(_harness_usec)
+    printf '\\x1e%s %s\\n' "$index" $(( (end - start) / {repeat} ))
+    (( ${{#COMPREPLY[@]}} )) && printf '%s\\n' "${{COMPREPLY[@]}}"
+    return 0
+}}
+"""
+
+
+def _quote(word):
+    return "'{0}'".format(word.replace("'", "'\\''"))
+
+
+class CompletionState(object):
+    """A command line to complete: the subcommand path, followed by the word being completed"""
+    def __init__(self, cmd, path, current, expected):
+        self.cmd = cmd
+        self.path = path
+        self.current = current
+        self.expected = expected
+
+    @property
+    def words(self):
+        return [self.cmd] + list(self.path) + [self.current]
+
+    @property
+    def key(self):
+        return " ".join(list(self.path) + ["[{0}]".format(self.current)])
+
+
+def get_states(cmd, param_tree):
+    """Returns the CompletionStates of every subcommand path. bash suggests the options after "-", and the options
+    and the subcommands after an empty word"""
+    states = []
+    for path, node in param_tree.walk():
+        options = set(node.options)
+        states.append(CompletionState(cmd, path, "", options | set(node.subcommands)))
+        states.append(CompletionState(cmd, path, "-", options))
+    return states
+
+
+def _parse_records(output, count):
+    # returns a list of (candidates, average microseconds) by state index
+    records = [None] * count
+    for record in output.split(RECORD_SEPARATOR)[1:]:
+        lines = record.split("\n")
+        index, _, latency = lines[0].partition(" ")
+        records[int(index)] = ([line for line in lines[1:] if line], int(latency or 0))
+    return records
+
+
+def _run_shell(argv, cwd, timeout=SHELL_TIMEOUT):
+    # returns the output of the shell, or None if it can't be run, fails or times out
+    try:
+        process = subprocess.Popen(argv, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        stdout, _ = process.communicate()
+    finally:
+        timer.cancel()
+    if process.returncode != 0:
+        return None
+    return stdout.decode("utf-8", "replace")
+
+
+class _ShellDriver(object):
+    # writes the generated files of a command to a temporary directory, and completes the states in the shell
+    shell = None
+
+    def __init__(self, generator, cmd, param_tree, option_help, repeat):
+        self.generator = generator
+        self.cmd = cmd
+        self.param_tree = param_tree
+        self.option_help = option_help
+        self.repeat = repeat
+
+    def get_completion_filename(self):
+        raise NotImplementedError()
+
+    @staticmethod
+    def normalize(candidate):
+        return candidate
+
+    def _write_files(self, completion_dir):
+        files = [(self.get_completion_filename(),
+                  self.generator.get_completion_file_content(self.cmd, self.param_tree, self.option_help))]
+        files += self.generator.get_auxiliary_files(self.cmd, self.param_tree, self.option_help)
+        for relative_path, content in files:
+            file_path = os.path.join(completion_dir, relative_path)
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, "w") as fd:
+                fd.write(content)
+        return os.path.join(completion_dir, self.get_completion_filename())
+
+    def _complete(self, temp_dir, work_dir, script_path, states):
+        raise NotImplementedError()
+
+    def run(self, states):
+        """Returns a list of (candidates, average microseconds) by state, or None if the shell can't be run"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            work_dir = os.path.join(temp_dir, "work")
+            os.mkdir(work_dir)
+            script_path = self._write_files(os.path.join(temp_dir, "completions"))
+            output = self._complete(temp_dir, work_dir, script_path, states)
+        finally:
+            shutil.rmtree(temp_dir)
+        if output is None:
+            return None
+        return [(sorted(set(self.normalize(candidate) for candidate in record[0])), record[1])
+                if record is not None else None
+                for record in _parse_records(output, len(states))]
+
+
+class BashDriver(_ShellDriver):
+    shell = "bash"
+
+    def get_completion_filename(self):
+        return self.cmd
+
+    @staticmethod
+    def normalize(candidate):
+        # in descriptions mode, the candidates are "word  -- description"
+        return candidate.split()[0] if candidate.strip() else candidate
+
+    def _complete(self, temp_dir, work_dir, script_path, states):
+        driver = BASH_DRIVER_TEMPLATE.format(script=_quote(script_path), cmd=_quote(self.cmd), repeat=self.repeat)
+        driver += "".join("_harness_state {0} {1}\n".format(index, " ".join(_quote(word) for word in state.words))
+                          for index, state in enumerate(states))
+        driver_path = os.path.join(temp_dir, "driver.sh")
+        with open(driver_path, "w") as fd:
+            fd.write(driver)
+        return _run_shell(["bash", "--norc", "--noprofile", driver_path], work_dir)
+
+
+DRIVERS = dict(bash=BashDriver)
+
+
+def _get_shell(generator_name):
+    return generator_name.split("-")[0]
+
+
+def get_harness_generators():
+    """Returns the generators of benchmark.get_generators whose shell has a driver"""
+    from .benchmark import get_generators
+    return [(name, generator) for name, generator in get_generators() if _get_shell(name) in DRIVERS]
+
+
+def check_generator(generator, shell, cmd, param_tree, option_help, repeat=10):
+    """Completes every state of the command in the shell. Returns a dict of the results by state key,
+    or None if the shell can't be run"""
+    states = get_states(cmd, param_tree)
+    records = DRIVERS[shell](generator, cmd, param_tree, option_help, repeat).run(states)
+    if records is None:
+        return None
+    results = {}
+    for state, record in zip(states, records):
+        expected = sorted(DRIVERS[shell].normalize(word) for word in state.expected)
+        if record is None:
+            results[state.key] = dict(ok=False, usec=None, missing=expected, unexpected=[])
+            continue
+        candidates, usec = record
+        result = dict(ok=candidates == expected, usec=usec)
+        if not result["ok"]:
+            result["missing"] = sorted(set(expected) - set(candidates))
+            result["unexpected"] = sorted(set(candidates) - set(expected))
+        results[state.key] = result
+    return results
+
+
+def run_harness(cmd, param_tree, option_help, generators=None, repeat=10):
+    """Checks the generated scripts of every generator (a list of (name, generator), where the name starts with the
+    shell, as in benchmark.get_generators), get_harness_generators() by default. Returns the results as a
+    JSON-compatible dict"""
+    if generators is None:
+        generators = get_harness_generators()
+    results = {}
+    for generator_name, generator in generators:
+        shell = _get_shell(generator_name)
+        states = check_generator(generator, shell, cmd, param_tree, option_help, repeat)
+        if states is None:
+            results[generator_name] = dict(shell=shell, skipped=True)
+            continue
+        latencies = [state["usec"] for state in states.values() if state["usec"] is not None]
+        results[generator_name] = dict(shell=shell, skipped=False, states=states,
+                                       failed=sum(1 for state in states.values() if not state["ok"]),
+                                       max_usec=max(latencies or [0]))
+    return dict(version=HARNESS_FORMAT_VERSION,
+                python=platform.python_version(),
+                command=cmd,
+                parameters=dict(repeat=repeat),
+                generators=results)
+
+
+def iter_failures(results):
+    """Yields a description of every state whose candidates are wrong"""
+    for generator_name, generator_results in sorted(results["generators"].items()):
+        for key, state in sorted(generator_results.get("states", {}).items()):
+            if not state["ok"]:
+                yield "{0} {1}: missing {2}, unexpected {3}".format(generator_name, key, state["missing"],
+                                                                    state["unexpected"])
+
+
+def compare_with_baseline(baseline, results, threshold=1.5, noise_usec=LATENCY_NOISE_USEC):
+    """Returns a list of the regressions from the baseline: states whose candidates were right and are wrong now,
+    and states that take threshold times longer (and at least noise_usec more) than they did"""
+    regressions = []
+    for generator_name, generator_results in sorted(results["generators"].items()):
+        baseline_states = baseline.get("generators", {}).get(generator_name, {}).get("states", {})
+        for key, state in sorted(generator_results.get("states", {}).items()):
+            baseline_state = baseline_states.get(key)
+            if baseline_state is None:
+                continue
+            if baseline_state["ok"] and not state["ok"]:
+                regressions.append("{0} {1}: candidates changed, missing {2}, unexpected {3}".format(
+                                   generator_name, key, state["missing"], state["unexpected"]))
+            if state["usec"] is None or not baseline_state["usec"]:
+                continue
+            if state["usec"] > baseline_state["usec"] * threshold and \
+                    state["usec"] - baseline_state["usec"] >= noise_usec:
+                regressions.append("{0} {1}: {2}us, was {3}us".format(generator_name, key, state["usec"],
+                                                                      baseline_state["usec"]))
+    return regressions
+
+
+def _select_generators(names):
+    generators = get_harness_generators()
+    if names == "all":
+        return generators
+    names = [name.strip() for name in names.split(",") if name.strip()]
+    known_names = [name for name, _ in generators]
+    for name in names:
+        if name not in known_names:
+            raise ValueError("Unknown generator {0}. The generators are {1}".format(name, ", ".join(known_names)))
+    return [(name, generator) for name, generator in generators if name in names]
+
+
+def main(argv=None):
+    import docopt
+    from .common import parse_params, parse_usage
+    arguments = docopt.docopt(__doc__.format(LATENCY_NOISE_USEC), argv)
+    try:
+        generators = _select_generators(arguments["--generators"])
+    except ValueError as e:
+        print(e.args[0], file=sys.stderr)
+        return 1
+    if arguments["<script>"] and not arguments["--usage"]:
+        cmd = os.path.basename(arguments["<script>"])
+        param_tree, option_help = parse_params(arguments["<script>"])
+    else:
+        if arguments["--usage"]:
+            with open(arguments["--usage"]) as fd:
+                usage = fd.read()
+        else:
+            from .benchmark import generate_usage
+            usage = generate_usage(int(arguments["--fanout"]), int(arguments["--depth"]), int(arguments["--options"]),
+                                   int(arguments["--arguments"]))
+        param_tree, option_help = parse_usage(usage)
+        cmd = os.path.basename(arguments["<script>"] or option_help.program_name)
+    results = run_harness(cmd, param_tree, option_help, generators, int(arguments["--repeat"]))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if arguments["--output"]:
+        with open(arguments["--output"], "w") as fd:
+            fd.write(output + "\n")
+    else:
+        print(output)
+    for generator_name, generator_results in sorted(results["generators"].items()):
+        if generator_results["skipped"]:
+            print("{0}: skipped, {1} can't be run".format(generator_name, generator_results["shell"]),
+                  file=sys.stderr)
+        else:
+            print("{0}: {1} states, {2} wrong, slowest {3}us".format(
+                  generator_name, len(generator_results["states"]), generator_results["failed"],
+                  generator_results["max_usec"]), file=sys.stderr)
+    if arguments["--baseline"]:
+        with open(arguments["--baseline"]) as fd:
+            baseline = json.load(fd)
+        problems = compare_with_baseline(baseline, results, float(arguments["--threshold"]))
+    else:
+        problems = list(iter_failures(results))
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Helpers for running subprocesses with a deadline, on both python 2 and 3 (where Popen.wait and check_output
+take no timeout in python 2)"""
+import os
+import subprocess
+import threading
+import time
+
+# time.monotonic doesn't exist in python 2
+clock = getattr(time, "monotonic", time.time)
+
+
+def wait_process(process, deadline):
+    """Returns the return code of a Popen, or None if it's still running at the deadline (a clock() time)"""
+    delay = 0.001
+    while True:
+        returncode = process.poll()
+        remaining = deadline - clock()
+        if returncode is not None or remaining <= 0:
+            return returncode
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+def kill_process(process):
+    """Kills a Popen, if it hasn't exited already"""
+    try:
+        process.kill()
+    except OSError:
+        # already exited
+        pass
+
+
+def _read_and_close(stream, output):
+    try:
+        output.append(stream.read())
+    finally:
+        stream.close()
+
+
+def run_process(argv, timeout):
+    """Runs argv with its stdin and stderr redirected to /dev/null. Returns (return code, output), or (None, None) if
+    it doesn't finish within timeout seconds, in which case it's killed. Raises OSError if it can't be run.
+    Unlike check_output in python 3, this doesn't wait for children that the process leaves its stdout to"""
+    with open(os.devnull, "r+b") as devnull:
+        process = subprocess.Popen(argv, stdin=devnull, stdout=subprocess.PIPE, stderr=devnull)
+    output = []
+    reader = threading.Thread(target=_read_and_close, args=(process.stdout, output))
+    reader.daemon = True
+    reader.start()
+    deadline = clock() + timeout
+    reader.join(timeout)
+    returncode = wait_process(process, deadline)
+    if returncode is None:
+        kill_process(process)
+        process.wait()
+        return None, None
+    if not output:
+        # the process exited, but a child still holds its stdout
+        return returncode, b""
+    return returncode, output[0]
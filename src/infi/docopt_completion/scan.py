@@ -0,0 +1,241 @@
+"""Finds the docopt scripts installed in a Python environment, without running or importing them.
+
+The console_scripts entry points are read from the metadata of the installed distributions, and the source of
+every entry point module is checked for a docopt usage text, as with --static. The results are kept in an index
+under the cache directory, and on the next scan only the distributions whose entry points changed, and the
+modules whose source changed, are read again.
+"""
+import ast
+import hashlib
+import json
+import os
+import sys
+from .stats import phase
+from .static import WRAPPER_MODULES, _read_source, _parse_source, find_usage_in_module, find_module_source
+
+# bump this whenever the index format changes, so old indexes are never loaded
+INDEX_FORMAT_VERSION = 1
+
+ENTRY_POINTS_FILENAME = "entry_points.txt"
+CONSOLE_SCRIPTS_SECTION = "console_scripts"
+
+# a cheap test before parsing a module: modules that don't mention docopt can't contain its usage
+DOCOPT_MARKER = b"docopt"
+
+
+def _get_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+def parse_console_scripts(text):
+    """Returns a list of (name, module, function) of the console_scripts section of an entry_points.txt file"""
+    scripts = []
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith(("#", ";")):
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1].strip()
+            continue
+        if section != CONSOLE_SCRIPTS_SECTION or "=" not in line:
+            continue
+        name, value = [part.strip() for part in line.split("=", 1)]
+        # drop the extras, like "module:function [extra]"
+        value = value.split("[")[0].strip()
+        module, _, function = value.partition(":")
+        scripts.append((name, module.strip(), function.strip()))
+    return scripts
+
+
+def iter_distributions(path):
+    """Yields the (metadata directory, import root) of every distribution installed in a sys.path directory"""
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return
+    for name in names:
+        if name.endswith(".dist-info") or name.endswith(".egg-info"):
+            yield os.path.join(path, name), path
+        elif name.endswith(".egg"):
+            yield os.path.join(path, name, "EGG-INFO"), os.path.join(path, name)
+
+
+def _get_relative_import_base(module_name, module_path, level):
+    parts = module_name.split(".")
+    if os.path.basename(module_path) != "__init__.py":
+        parts = parts[:-1]
+    return parts[:len(parts) - (level - 1)] if level > 1 else parts
+
+
+def _find_function_module(tree, module_name, module_path, function):
+    # the module that the entry point function is imported from, like "from .cli import main"
+    for node in tree.body:
+        if not isinstance(node, ast.ImportFrom):
+            continue
+        if not any((alias.asname or alias.name) == function for alias in node.names):
+            continue
+        if not node.level:
+            return node.module
+        base = _get_relative_import_base(module_name, module_path, node.level)
+        return ".".join(base + ([node.module] if node.module else []))
+    return None
+
+
+def _find_usage_in_source(source):
+    if source is None or DOCOPT_MARKER not in source:
+        return None
+    tree = _parse_source(source)
+    return find_usage_in_module(tree) if tree is not None else None
+
+
+def find_entry_point_usage(module, function, search_paths):
+    """Returns (the source file of the usage text, the usage text) of an entry point, or (source file, None) if
+    the module doesn't use docopt. If the function is imported from another module, that module is checked too"""
+    module_path = find_module_source(module, search_paths)
+    if module_path is None:
+        return None, None
+    source = _read_source(module_path)
+    if source is None:
+        return module_path, None
+    usage = _find_usage_in_source(source)
+    if usage is not None:
+        return module_path, usage
+    function_name = function.split(".")[0]
+    if not function_name or "def {0}(".format(function_name).encode("utf-8") in source:
+        # the function is defined in the module rather than imported
+        return module_path, None
+    tree = _parse_source(source)
+    function_module = _find_function_module(tree, module, module_path, function_name) if tree is not None else None
+    if function_module is None or function_module in WRAPPER_MODULES:
+        return module_path, None
+    function_module_path = find_module_source(function_module, search_paths)
+    if function_module_path is None:
+        return module_path, None
+    usage = _find_usage_in_source(_read_source(function_module_path))
+    return (function_module_path, usage) if usage is not None else (module_path, None)
+
+
+def get_default_index_path(paths):
+    from .cache import get_default_cache_dir
+    key = hashlib.sha256("\0".join([sys.executable] + paths).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(get_default_cache_dir(), "environment-{0}.json".format(key))
+
+
+class EnvironmentIndex(object):
+    """An index of the console_scripts of a Python environment to their docopt usage texts.
+
+    paths are the directories to look for distributions in, sys.path by default. The index is loaded from
+    index_path by load() and written back by save(), and scan() reads only what changed since it was written"""
+    def __init__(self, paths=None, index_path=None):
+        self.paths = self._get_paths(sys.path if paths is None else paths)
+        self.index_path = index_path or get_default_index_path(self.paths)
+        # entry_points.txt path -> {"signature": ..., "scripts": {name: script record}}
+        self.distributions = {}
+        self.scripts = {}
+
+    def _get_paths(self, paths):
+        result = []
+        real_paths = set()
+        for path in paths:
+            path = os.path.abspath(path or os.curdir)
+            real_path = os.path.realpath(path)
+            if real_path not in real_paths and os.path.isdir(path):
+                real_paths.add(real_path)
+                result.append(path)
+        return result
+
+    def load(self):
+        try:
+            with open(self.index_path, "rb") as fd:
+                index = json.loads(fd.read().decode("utf-8"))
+            if index.get("version") == INDEX_FORMAT_VERSION and index.get("paths") == self.paths:
+                self.distributions = index["distributions"]
+        except Exception:
+            # a missing or broken index is scanned from scratch
+            self.distributions = {}
+        return self
+
+    def save(self):
+        import tempfile
+        index_dir = os.path.dirname(self.index_path)
+        try:
+            if not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            fd, temp_path = tempfile.mkstemp(dir=index_dir, suffix=".tmp")
+            index = dict(version=INDEX_FORMAT_VERSION, paths=self.paths, distributions=self.distributions)
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(json.dumps(index).encode("utf-8"))
+            os.rename(temp_path, self.index_path)
+        except (IOError, OSError):
+            # the index is an optimization, failing to write it is not an error
+            pass
+
+    def _scan_distribution(self, entry_points_path, root, signature, details):
+        old = self.distributions.get(entry_points_path)
+        if old is not None and old["signature"] == signature:
+            scripts = old["scripts"]
+        else:
+            details["distributions_read"] += 1
+            try:
+                with open(entry_points_path, "rb") as fd:
+                    text = fd.read().decode("utf-8", "replace")
+            except (IOError, OSError):
+                text = ""
+            scripts = dict((name, dict(module=module, function=function, source=None, signature=None, usage=None))
+                           for name, module, function in parse_console_scripts(text))
+        search_paths = [root] + self.paths
+        for script in scripts.values():
+            if script["source"] is not None and _get_signature(script["source"]) == script["signature"]:
+                continue
+            details["modules_read"] += 1
+            source, script["usage"] = find_entry_point_usage(script["module"], script["function"], search_paths)
+            script["source"] = source
+            script["signature"] = _get_signature(source) if source is not None else None
+        return dict(signature=signature, scripts=scripts)
+
+    def scan(self):
+        """Updates the index with the distributions installed in the paths, and returns self"""
+        distributions = {}
+        self.scripts = {}
+        with phase("scan_environment") as details:
+            details.update(distributions=0, distributions_read=0, modules_read=0)
+            for path in self.paths:
+                for metadata_path, root in iter_distributions(path):
+                    entry_points_path = os.path.join(metadata_path, ENTRY_POINTS_FILENAME)
+                    signature = _get_signature(entry_points_path)
+                    if signature is None or entry_points_path in distributions:
+                        continue
+                    details["distributions"] += 1
+                    distribution = self._scan_distribution(entry_points_path, root, signature, details)
+                    distributions[entry_points_path] = distribution
+                    for name, script in sorted(distribution["scripts"].items()):
+                        # like the installers, the first distribution on the path wins
+                        self.scripts.setdefault(name, script)
+        # removed distributions are dropped from the index
+        self.distributions = distributions
+        return self
+
+    def get_usage(self, name):
+        """Returns the usage text of a console script, or None if it isn't a docopt script in this environment"""
+        script = self.scripts.get(name)
+        return script["usage"] if script is not None else None
+
+    def get_docopt_scripts(self):
+        """Returns the names of the console scripts that use docopt, sorted"""
+        return sorted(name for name, script in self.scripts.items() if script["usage"] is not None)
+
+
+def scan_environment(paths=None, index_path=None, use_index=True):
+    """Returns an EnvironmentIndex of the environment, reusing and updating the index written by the previous scan"""
+    index = EnvironmentIndex(paths, index_path)
+    if use_index:
+        index.load()
+    index.scan()
+    if use_index:
+        index.save()
+    return index
@@ -0,0 +1,196 @@
+import ast
+import glob
+import os
+import sys
+from .cache import resolve_executable
+
+# modules imported by console_scripts wrappers that never contain the usage text
+WRAPPER_MODULES = frozenset(["sys", "os", "re", "pkg_resources", "importlib", "importlib.metadata",
+                             "importlib_metadata", "__future__"])
+
+STRING_TYPES = (type(""), type(u""))
+
+
+def _read_source(path):
+    try:
+        with open(path, "rb") as fd:
+            source = fd.read()
+    except (IOError, OSError):
+        return None
+    if b"\0" in source:
+        # a binary executable
+        return None
+    return source
+
+
+def _parse_source(source):
+    try:
+        return ast.parse(source)
+    except (SyntaxError, ValueError, TypeError):
+        # not a python script (a shell wrapper, for example)
+        return None
+
+
+def _get_string_value(node):
+    node_type = type(node).__name__
+    if node_type == "Constant":
+        value = node.value
+    elif node_type == "Str":
+        value = node.s
+    else:
+        return None
+    return value if isinstance(value, STRING_TYPES) else None
+
+
+def _is_docopt_call(node):
+    if not isinstance(node, ast.Call):
+        return False
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id == "docopt"
+    return isinstance(func, ast.Attribute) and func.attr == "docopt"
+
+
+def _get_docopt_doc_argument(call):
+    if call.args:
+        return call.args[0]
+    for keyword in call.keywords:
+        if keyword.arg == "doc":
+            return keyword.value
+    return None
+
+
+def _is_usage(text):
+    return text is not None and "usage:" in text.lower()
+
+
+def _imports_docopt(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            if node.module.split(".")[0] == "docopt":
+                return True
+        elif isinstance(node, ast.Import):
+            if any(alias.name.split(".")[0] == "docopt" for alias in node.names):
+                return True
+    return False
+
+
+def find_usage_in_module(tree):
+    """Returns the usage text passed to docopt() in a parsed module, or None if it can't be determined statically.
+
+    The usage may be a string literal, the module docstring (__doc__), or a module-level variable
+    assigned a string literal. If docopt() is never called but the module imports docopt, the module docstring
+    is used if it looks like a docopt usage text."""
+    module_strings = {"__doc__": ast.get_docstring(tree, clean=False)}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            value = _get_string_value(node.value)
+            if value is not None:
+                module_strings[node.targets[0].id] = value
+    for node in ast.walk(tree):
+        if not _is_docopt_call(node):
+            continue
+        doc = _get_docopt_doc_argument(node)
+        usage = _get_string_value(doc)
+        if usage is None and isinstance(doc, ast.Name):
+            usage = module_strings.get(doc.id)
+        if _is_usage(usage):
+            return usage
+    docstring = module_strings["__doc__"]
+    return docstring if _is_usage(docstring) and _imports_docopt(tree) else None
+
+
+def _get_imported_modules(tree):
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            yield node.module
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                yield alias.name
+
+
+def _get_interpreter_search_paths(source):
+    # the script may run with another interpreter (a virtualenv, for example), whose packages aren't in our sys.path
+    first_line = source.splitlines()[0] if source else b""
+    if not first_line.startswith(b"#!"):
+        return []
+    interpreter = first_line[2:].decode("utf-8", "replace").split()
+    if not interpreter or os.path.basename(interpreter[0]) == "env":
+        return []
+    prefix = os.path.dirname(os.path.dirname(interpreter[0]))
+    return glob.glob(os.path.join(prefix, "lib", "python*", "site-packages"))
+
+
+def find_module_source(module_name, search_paths):
+    """Finds the source file of a module without importing it or its parent packages"""
+    parts = module_name.split(".")
+    for search_path in search_paths:
+        module_path = os.path.join(search_path or os.curdir, *parts)
+        for candidate in [module_path + ".py", os.path.join(module_path, "__init__.py")]:
+            if os.path.isfile(candidate):
+                return candidate
+    return None
+
+
+def find_console_script_module(name):
+    """Returns the module of an installed console_scripts entry point, read from the distributions' metadata"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return None
+        for entry_point in pkg_resources.iter_entry_points("console_scripts", name):
+            return entry_point.module_name
+        return None
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, "select"):
+        console_scripts = all_entry_points.select(group="console_scripts")
+    else:
+        console_scripts = all_entry_points.get("console_scripts", [])
+    for entry_point in console_scripts:
+        if entry_point.name == name:
+            return entry_point.value.split(":")[0].strip()
+    return None
+
+
+def _find_usage_in_file(path):
+    source = _read_source(path)
+    tree = _parse_source(source) if source is not None else None
+    if tree is None:
+        return None
+    return find_usage_in_module(tree)
+
+
+def get_static_usage(cmd):
+    """Finds the docopt usage text of a script without running it.
+
+    The script itself is parsed first. If it is a console_scripts wrapper, the modules it imports
+    (or the module of the installed entry point with the same name) are parsed instead.
+    Returns None if the usage text can't be found."""
+    path = resolve_executable(cmd)
+    if path is None:
+        return None
+    source = _read_source(path)
+    tree = _parse_source(source) if source is not None else None
+    if tree is not None:
+        usage = find_usage_in_module(tree)
+        if usage is not None:
+            return usage
+        module_names = [name for name in _get_imported_modules(tree) if name not in WRAPPER_MODULES]
+        search_paths = [os.path.dirname(path)] + sys.path + _get_interpreter_search_paths(source)
+    else:
+        module_names = []
+        search_paths = sys.path
+    entry_point_module = find_console_script_module(os.path.basename(cmd))
+    if entry_point_module is not None:
+        module_names.append(entry_point_module)
+    for module_name in module_names:
+        module_path = find_module_source(module_name, search_paths)
+        if module_path is None:
+            continue
+        usage = _find_usage_in_file(module_path)
+        if usage is not None:
+            return usage
+    return None
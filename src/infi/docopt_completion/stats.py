@@ -0,0 +1,109 @@
+"""Per-phase timing of completion generation.
+
+The code is instrumented with the phase() context manager. Every phase that finishes is passed as a PhaseRecord
+to the registered hooks, so callers can observe a run without changing it:
+
+    collector = StatsCollector()
+    with collector:
+        docopt_completion(...)
+    print(collector.format())
+"""
+import threading
+import time
+
+# time.monotonic doesn't exist in python 2
+_clock = getattr(time, "monotonic", time.time)
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Registers a callable that is called with a PhaseRecord whenever a phase finishes.
+    Hooks may be called from several threads at once"""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def enabled():
+    """Returns True if any hook is registered. Counters that are expensive to compute are only computed then"""
+    return len(_hooks) > 0
+
+
+class PhaseRecord(object):
+    """A finished phase: its name, wall time in seconds, and counters such as "bytes" and "nodes" """
+    def __init__(self, name, seconds, details):
+        self.name = name
+        self.seconds = seconds
+        self.details = details
+
+    def __repr__(self):
+        return "<PhaseRecord {0}: {1:.6f}s {2}>".format(self.name, self.seconds, self.details)
+
+
+class phase(object):
+    """Times the code in a with block. Counters can be given upfront or added to the details dict
+    inside the block, where they are known:
+
+        with phase("get_usage") as details:
+            usage = ...
+            details["bytes"] = len(usage)
+    """
+    def __init__(self, name, **details):
+        self.name = name
+        self.details = details
+        self.start = None
+
+    def __enter__(self):
+        self.start = _clock()
+        return self.details
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not _hooks:
+            return
+        if exc_type is not None:
+            self.details["failed"] = 1
+        record = PhaseRecord(self.name, _clock() - self.start, self.details)
+        for hook in list(_hooks):
+            hook(record)
+
+
+class StatsCollector(object):
+    """A hook that sums the wall time, the number of calls and the counters of every phase.
+    Used as a context manager, it registers itself as a hook for the duration of the block"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+
+    def __call__(self, record):
+        with self.lock:
+            totals = self.phases.setdefault(record.name, dict(count=0, seconds=0.0))
+            totals["count"] += 1
+            totals["seconds"] += record.seconds
+            for key, value in record.details.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + value
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_hook(self)
+
+    def to_dict(self):
+        with self.lock:
+            return dict((name, dict(totals)) for name, totals in self.phases.items())
+
+    def format(self):
+        phases = self.to_dict()
+        counters = sorted(set(key for totals in phases.values() for key in totals) - set(["count", "seconds"]))
+        lines = ["{0:<40} {1:>6} {2:>10}".format("phase", "count", "seconds") +
+                 "".join(" {0:>10}".format(counter) for counter in counters)]
+        for name, totals in sorted(phases.items()):
+            line = "{0:<40} {1:>6} {2:>10.4f}".format(name, totals["count"], totals["seconds"])
+            line += "".join(" {0:>10}".format(totals.get(counter, "")) for counter in counters)
+            lines.append(line)
+        return "\n".join(lines)
@@ -0,0 +1,350 @@
+"""Parses large docopt usage texts into the same command trees and help indexes as parse_usage does with docopt's
+parser, in time that grows linearly with the size of the text.
+
+docopt parses the whole usage section as a single token stream, removing every token from the front of a list,
+so its parsing time grows with the square of the number of usage lines, and the tree is then built by recursing
+over the pattern. Here the usage text, its options and its descriptions are read in one pass over the lines. Every
+usage pattern (the words between two occurrences of the program name, as docopt splits them) is parsed on its own,
+over an indexed token stream, with docopt's own option parsing. The parser doesn't build docopt's pattern objects:
+every group and atom is compiled to the flat list of instructions that builds its part of the tree, and groups and
+options that repeat across patterns, like a common "[--verbose | --quiet]", are compiled once. The instructions of
+all the patterns are then run in a loop, so neither step is limited by the recursion limit.
+
+Usage texts that docopt can't parse are passed to parse_usage's docopt parser, so the errors are docopt's.
+"""
+import json
+import re
+from .common import CommandParams, HelpIndex, get_program_name, iter_line_descriptions
+from .stats import phase, enabled as stats_enabled
+
+USAGE_LABEL = re.compile(r"[Uu][Ss][Aa][Gg][Ee]:")
+
+# docopt's parse_defaults starts a new option description at every line that starts with one of these
+DEFAULTS_LINE = re.compile(r" *(<\S+?>|-\S+?)")
+
+# docopt's tokenization of usage patterns
+TOKEN_SEPARATORS = re.compile(r"([\[\]\(\)\|]|\.\.\.)")
+
+CLOSINGS = {"(": ")", "[": "]"}
+CLOSINGS_SET = set(CLOSINGS.values())
+
+# the instructions that build the tree. the current node starts at the root of the tree.
+# OPTION, ARGUMENT: add an option or an argument to the current node
+# COMMAND: make the named subcommand of the current node the current node
+# SAVE, RESTORE, DROP: push the current node, go back to the pushed node, and pop it
+OPTION, ARGUMENT, COMMAND, SAVE, RESTORE, DROP = range(6)
+
+
+class UsageScan(object):
+    """The parts of a usage text that are read in a single pass over its lines: the usage section, the options
+    (as docopt's parse_defaults finds them) and the descriptions (as common.iter_descriptions finds them)"""
+    def __init__(self, doc):
+        from docopt import DocoptLanguageError, Option
+        self.options = []
+        self.descriptions = []
+        usage_lines = []
+        usage_labels = 0
+        in_usage = False
+        option_lines = None
+        lines = doc.split("\n")
+        for index, line in enumerate(lines):
+            labels = USAGE_LABEL.findall(line) if ":" in line else ()
+            if labels:
+                if usage_labels == 0:
+                    usage_lines.append(line[USAGE_LABEL.search(line).start():])
+                    in_usage = True
+                usage_labels += len(labels)
+            elif in_usage:
+                # the section ends at a blank line that is followed by another line, like docopt's "\n\s*\n"
+                if not line.strip() and index + 1 < len(lines):
+                    in_usage = False
+                else:
+                    usage_lines.append(line)
+            if index == 0:
+                continue
+            match = DEFAULTS_LINE.match(line)
+            if match:
+                self._add_option(Option, option_lines)
+                option_lines = [line[match.start(1):]]
+            elif option_lines is not None:
+                option_lines.append(line)
+            if line.startswith("  "):
+                self.descriptions.extend(iter_line_descriptions(line))
+        self._add_option(Option, option_lines)
+        if usage_labels == 0:
+            raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
+        if usage_labels > 1:
+            raise DocoptLanguageError('More than one "usage:" (case-insensitive).')
+        self.usage_section = "\n".join(usage_lines).strip()
+
+    def _add_option(self, option_class, option_lines):
+        if option_lines is not None and option_lines[0].startswith("-"):
+            self.options.append(option_class.parse("\n".join(option_lines)))
+
+
+class _TokenStream(object):
+    # the interface of docopt's TokenStream, for docopt's parse_long and parse_shorts, without removing tokens from
+    # the front of a list
+    def __init__(self, tokens, error):
+        self.tokens = tokens
+        self.index = 0
+        self.error = error
+
+    def move(self):
+        token = self.current()
+        if token is not None:
+            self.index += 1
+        return token
+
+    def current(self):
+        return self.tokens[self.index] if self.index < len(self.tokens) else None
+
+
+# compiled code is a pair of (instructions, whether running them moves the current node to a subcommand)
+
+def _chain(items):
+    # a sequence, where every item starts at the node the previous one moved to (docopt's Required)
+    instructions = []
+    for item_instructions, _ in items:
+        instructions.extend(item_instructions)
+    return instructions, any(moves for _, moves in items)
+
+
+def _branch(items):
+    # items that all start at the current node (docopt's Either, Optional and OneOrMore)
+    if not any(moves for _, moves in items):
+        return _chain(items)
+    instructions = [(SAVE, None)]
+    for item_instructions, moves in items:
+        instructions.extend(item_instructions)
+        if moves:
+            instructions.append((RESTORE, None))
+    instructions.append((DROP, None))
+    return instructions, False
+
+
+def _compile_options(options):
+    instructions = []
+    for option in options:
+        suffix = "=" if option.argcount else ""
+        if option.short:
+            instructions.append((OPTION, option.short + suffix))
+        if option.long:
+            instructions.append((OPTION, option.long + suffix))
+    return instructions, False
+
+
+class _Group(object):
+    # a group being parsed: the items of the current sequence, and the alternatives before it
+    __slots__ = ("opening", "key", "closing", "items", "alternatives", "last_atom_size")
+
+    def __init__(self, opening, key=None, closing=None):
+        # key is the tokens of the group, up to the closing bracket found at index closing
+        self.opening = opening
+        self.key = key
+        self.closing = closing
+        self.items = []
+        self.alternatives = None
+        # the number of items added by the last atom, which "..." applies to, or None if "..." can't follow
+        self.last_atom_size = None
+
+    def add_atom(self, items):
+        self.items.extend(items)
+        self.last_atom_size = len(items)
+
+    def add_alternative(self):
+        if self.alternatives is None:
+            self.alternatives = []
+        if self.items:
+            self.alternatives.append(_chain(self.items))
+        self.items = []
+        self.last_atom_size = None
+
+    def get_items(self):
+        # the items of docopt's parse_expr
+        if self.alternatives is None:
+            return self.items
+        self.add_alternative()
+        if len(self.alternatives) > 1:
+            return [_branch(self.alternatives)]
+        return self.alternatives
+
+
+class PatternCompiler(object):
+    """Compiles usage patterns, sharing the compiled groups and options between them.
+    options is the list of docopt Options, which docopt's option parsing adds the undescribed options to"""
+    def __init__(self, options):
+        from docopt import DocoptLanguageError, parse_long, parse_shorts
+        self.options = options
+        self.error = DocoptLanguageError
+        self.parse_long = parse_long
+        self.parse_shorts = parse_shorts
+        self.groups = {}
+        self.atoms = {}
+        self.structure = {"(": self._open, "[": self._open, ")": self._close, "]": self._close,
+                          "|": self._alternative, "...": self._repeat}
+
+    def compile(self, pattern):
+        """Returns the compiled code of a usage pattern, as docopt parses "( <pattern> )" """
+        # the same tokens as docopt's re.sub(r" \1 "), which is slower
+        tokens = " ".join(TOKEN_SEPARATORS.split(pattern)).split()
+        stream = _TokenStream(tokens, self.error)
+        groups = [_Group("(")]
+        while stream.current() is not None:
+            handler = self.structure.get(stream.current(), self._atom)
+            handler(stream, groups)
+        if len(groups) > 1:
+            raise self.error("unmatched '{0}'".format(groups[-1].opening))
+        return _chain(groups[0].get_items())
+
+    def _find_closing(self, tokens, start):
+        depth = 0
+        for index in range(start, len(tokens)):
+            if tokens[index] in CLOSINGS:
+                depth += 1
+            elif tokens[index] in CLOSINGS_SET:
+                depth -= 1
+                if depth == 0:
+                    return index
+        return None
+
+    def _open(self, stream, groups):
+        opening = stream.tokens[stream.index]
+        closing = self._find_closing(stream.tokens, stream.index)
+        if closing is None:
+            raise self.error("unmatched '{0}'".format(opening))
+        key = tuple(stream.tokens[stream.index:closing + 1])
+        if key in self.groups:
+            stream.index = closing + 1
+            groups[-1].add_atom([self.groups[key]])
+            return
+        stream.move()
+        groups.append(_Group(opening, key, closing))
+
+    def _close(self, stream, groups):
+        closing = stream.move()
+        group = groups.pop()
+        if len(groups) == 0 or CLOSINGS[group.opening] != closing:
+            raise self.error("unmatched '{0}'".format(group.opening))
+        items = group.get_items()
+        code = _chain(items) if group.opening == "(" else _branch(items)
+        if stream.index - 1 == group.closing:
+            # unless an option took the closing bracket as its argument, the same tokens always compile the same
+            self.groups[group.key] = code
+        groups[-1].add_atom([code])
+
+    def _alternative(self, stream, groups):
+        stream.move()
+        groups[-1].add_alternative()
+
+    def _repeat(self, stream, groups):
+        group = groups[-1]
+        if group.last_atom_size is None:
+            # docopt parses a "..." that doesn't follow an atom as a command
+            self._atom(stream, groups)
+            return
+        stream.move()
+        atom = group.items[len(group.items) - group.last_atom_size:]
+        del group.items[len(group.items) - group.last_atom_size:]
+        group.items.append(_branch(atom))
+        group.last_atom_size = None
+
+    def _atom(self, stream, groups):
+        # the items of docopt's parse_atom, for tokens that aren't groups
+        token = stream.current()
+        if token.startswith("-") and token not in ("-", "--"):
+            groups[-1].add_atom(self._option_atom(stream))
+        elif token == "options":
+            stream.move()
+            groups[-1].add_atom([([], False)])
+        elif token.startswith("<") and token.endswith(">") or token.isupper():
+            groups[-1].add_atom([([(ARGUMENT, stream.move())], False)])
+        else:
+            groups[-1].add_atom([([(COMMAND, stream.move())], True)])
+
+    def _option_atom(self, stream):
+        # an option may take the next token as its argument, so the next token is part of the key
+        token = stream.current()
+        key = (token, stream.tokens[stream.index + 1] if stream.index + 1 < len(stream.tokens) else None)
+        if key in self.atoms:
+            items, size = self.atoms[key]
+            stream.index += size
+            return items
+        start = stream.index
+        parse = self.parse_long if token.startswith("--") else self.parse_shorts
+        items = [_compile_options([option]) for option in parse(stream, self.options)]
+        self.atoms[key] = (items, stream.index - start)
+        return items
+
+
+def iter_patterns(usage_section):
+    """Yields the usage patterns of a usage section, split at the program name like docopt's formal_usage"""
+    program_name = get_program_name(usage_section)
+    pattern = []
+    for word in usage_section.split()[2:]:
+        if word == program_name:
+            yield " ".join(pattern)
+            pattern = []
+        else:
+            pattern.append(word)
+    yield " ".join(pattern)
+
+
+def run_instructions(instructions, param_tree):
+    """Builds the command tree by running the instructions from the root"""
+    node = param_tree
+    stack = []
+    for operation, name in instructions:
+        if operation == OPTION:
+            node.add_option(name)
+        elif operation == COMMAND:
+            node = node.get_subcommand(name)
+        elif operation == ARGUMENT:
+            node.add_argument(name)
+        elif operation == SAVE:
+            stack.append(node)
+        elif operation == RESTORE:
+            node = stack[-1]
+        else:
+            stack.pop()
+
+
+def _parse(usage):
+    with phase("scan_usage", bytes=len(usage)):
+        scan = UsageScan(usage)
+    with phase("parse_pattern", bytes=len(scan.usage_section)) as details:
+        compiler = PatternCompiler(scan.options)
+        patterns = [compiler.compile(pattern) for pattern in iter_patterns(scan.usage_section)]
+        # the patterns are alternatives, unless there's only one
+        instructions = _branch(patterns)[0] if len(patterns) > 1 else patterns[0][0]
+        details.update(patterns=len(patterns), groups=len(compiler.groups), atoms=len(compiler.atoms))
+    with phase("build_command_tree") as details:
+        param_tree = CommandParams()
+        run_instructions(instructions, param_tree)
+        if stats_enabled():
+            details["nodes"] = sum(1 for _ in param_tree.walk())
+    with phase("help_index") as details:
+        option_help = HelpIndex(scan.descriptions, program_name=get_program_name(scan.usage_section))
+        details["entries"] = len(option_help)
+    return param_tree, option_help
+
+
+def parse_large_usage(usage):
+    """Returns (param_tree, option_help) for a usage text, like parse_usage"""
+    try:
+        return _parse(usage)
+    except Exception:
+        # docopt's parser raises its own error for the usage texts it can't parse
+        from .common import parse_usage
+        return parse_usage(usage, parser="docopt")
+
+
+def compare_parsers(usage):
+    """Parses a usage text with both parsers, and returns a list of the differences in their results"""
+    from .common import parse_usage, dump_params
+    results = [json.loads(dump_params(*parse_usage(usage, parser=parser))) for parser in ["docopt", "linear"]]
+    differences = []
+    for name in ["tree", "option_help"]:
+        if results[0][name] != results[1][name]:
+            differences.append("The {0} of the linear parser is different".format(name))
+    return differences
@@ -0,0 +1,247 @@
+"""Watches docopt scripts and the directories they are installed to, and regenerates the completion files of the
+scripts that change.
+
+Every scan stats the watched files, and reads a file only when its inode, size, mode or mtime changed, so a touched
+but unchanged script is not regenerated. On Linux the watcher sleeps on inotify between scans, so it uses no CPU
+while nothing changes; elsewhere it scans every interval seconds. Bursts of changes, like a package upgrade,
+are collected until nothing changed for debounce seconds, and then regenerated together.
+"""
+from __future__ import print_function
+import errno
+import hashlib
+import os
+import select
+import stat
+import sys
+import time
+from .stats import phase
+
+DEFAULT_INTERVAL = 1.0
+DEFAULT_DEBOUNCE = 0.5
+
+# with inotify, the watched paths are still scanned this often, in case an event was missed
+# or a watched directory was created after the watch started
+INOTIFY_RESCAN_INTERVAL = 60.0
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# in watched directories, only executable files that start with a shebang are treated as scripts
+SCRIPT_MAGIC = b"#!"
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# time.monotonic doesn't exist in python 2
+_clock = getattr(time, "monotonic", time.time)
+
+
+def _get_signature(path):
+    # returns None for missing files and files that aren't regular files
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_ino, st.st_size, st.st_mode, st.st_mtime
+
+
+def _hash_file(path, scripts_only):
+    # returns None if the file can't be read, or if scripts_only is set and the file isn't a script
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as fd:
+            block = fd.read(READ_BLOCK_SIZE)
+            if scripts_only and not block.startswith(SCRIPT_MAGIC):
+                return None
+            while block:
+                digest.update(block)
+                block = fd.read(READ_BLOCK_SIZE)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+class ScriptWatcher(object):
+    """Tells which scripts changed since the last scan.
+
+    scripts maps the paths of explicitly watched scripts to the commands their completion files are generated for.
+    Scripts that are added to or changed in the watched directories are reported by their paths"""
+    def __init__(self, scripts=None, directories=()):
+        self.scripts = dict(scripts or {})
+        self.directories = list(directories)
+        # path -> (signature, digest). the digest is None for files that aren't scripts
+        self.states = {}
+        # directory -> (signature, paths of the executable files in it)
+        self.listings = {}
+        self.scan()
+
+    def _scan_file(self, path, scripts_only):
+        # returns True if the file is a script whose content changed
+        old_state = self.states.get(path)
+        signature = _get_signature(path)
+        if signature is None:
+            self.states.pop(path, None)
+            return False
+        if old_state is not None and old_state[0] == signature:
+            return False
+        is_executable = signature[2] & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        digest = _hash_file(path, scripts_only) if is_executable or not scripts_only else None
+        self.states[path] = (signature, digest)
+        return digest is not None and (old_state is None or old_state[1] != digest)
+
+    def _list_directory(self, directory):
+        try:
+            signature = os.stat(directory).st_mtime
+        except OSError:
+            self.listings.pop(directory, None)
+            return []
+        listing = self.listings.get(directory)
+        if listing is None or listing[0] != signature:
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                names = []
+            listing = (signature, [os.path.join(directory, name) for name in names])
+            self.listings[directory] = listing
+        return listing[1]
+
+    def scan(self):
+        """Returns the paths of the scripts that changed since the last scan, in the order they are watched"""
+        changed = []
+        with phase("watch_scan") as details:
+            for path in sorted(self.scripts):
+                if self._scan_file(path, False):
+                    changed.append(path)
+            seen = set(self.scripts)
+            for directory in self.directories:
+                for path in self._list_directory(directory):
+                    if path in seen:
+                        continue
+                    seen.add(path)
+                    if self._scan_file(path, True):
+                        changed.append(path)
+            # forget the files that were removed from the watched directories
+            for path in set(self.states) - seen:
+                del self.states[path]
+            details["files"] = len(seen)
+            details["changed"] = len(changed)
+        return changed
+
+    def exists(self, path):
+        return path in self.states
+
+    def get_command(self, path):
+        return self.scripts.get(path, path)
+
+    def get_watched_directories(self):
+        """The directories whose changes should wake the watcher: the watched directories and the directories
+        of the watched scripts, so that scripts which are replaced rather than written to are noticed too"""
+        directories = []
+        for directory in self.directories + [os.path.dirname(path) for path in sorted(self.scripts)]:
+            if directory not in directories:
+                directories.append(directory)
+        return directories
+
+
+class PollWaiter(object):
+    """Waits between scans by sleeping"""
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.idle_timeout = interval
+
+    def add_directory(self, directory):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+class InotifyWaiter(object):
+    """Waits between scans until something changes in one of the directories, using inotify"""
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+        self.idle_timeout = INOTIFY_RESCAN_INTERVAL
+
+    @classmethod
+    def create(cls):
+        """Returns an InotifyWaiter, or None if inotify isn't available"""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (ImportError, OSError, AttributeError):
+            return None
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def add_directory(self, directory):
+        # directories that don't exist yet are found by the periodic rescan
+        self.libc.inotify_add_watch(self.fd, os.path.abspath(directory).encode(sys.getfilesystemencoding()),
+                                    INOTIFY_MASK)
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        # the events themselves don't matter, since the scan finds what changed
+        while True:
+            try:
+                if not os.read(self.fd, READ_BLOCK_SIZE):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_waiter(interval=DEFAULT_INTERVAL, use_inotify=True):
+    waiter = InotifyWaiter.create() if use_inotify else None
+    return waiter if waiter is not None else PollWaiter(interval)
+
+
+def watch(watcher, regenerate, interval=DEFAULT_INTERVAL, debounce=DEFAULT_DEBOUNCE, waiter=None):
+    """Calls regenerate with a list of the commands that changed, whenever the changes settled for debounce seconds.
+    Scripts that were removed meanwhile, like temporary files that were renamed, are left out. Runs until interrupted"""
+    waiter = waiter or create_waiter(interval)
+    for directory in watcher.get_watched_directories():
+        waiter.add_directory(directory)
+    pending = []
+    last_change = None
+    try:
+        while True:
+            if pending:
+                timeout = max(0, last_change + debounce - _clock())
+            else:
+                timeout = waiter.idle_timeout
+            waiter.wait(timeout)
+            changed = watcher.scan()
+            if changed:
+                pending.extend(path for path in changed if path not in pending)
+                last_change = _clock()
+            elif pending and _clock() - last_change >= debounce:
+                cmds = [watcher.get_command(path) for path in pending if watcher.exists(path)]
+                pending = []
+                if cmds:
+                    regenerate(cmds)
+    finally:
+        waiter.close()
@@ -1,7 +1,11 @@
 import os
-from .common import CompletionGenerator
+import re
+import subprocess
+from .common import (CompletionGenerator, HelpIndex, SharedSubtrees, SharedFragments, SKIPPED, escape_zsh_description,
+                     group_by_function)
+from .stats import phase
 
-# We fill the file template with the command name and the different sections
+# We fill the file template with the command name, the _message_next_arg helper and the different sections
 # generated from the templates below.
 # _message_next_arg: outputs the next positional argument name to the user
 # with the _message function. It counts the number of elements in the 'words'
@@ -9,9 +13,7 @@ from .common import CompletionGenerator
 # array defined by the caller to output the correct argument name.
 # We skip the first two elements in 'words' because the first is always empty and
 # the second is the last keyword before the options and arguments start.
-FILE_TEMPLATE = '''#compdef {0}
-
-_message_next_arg()
+MESSAGE_NEXT_ARG_TEMPLATE = '''{0}()
 {{
     argcount=0
     for word in "${{words[@][2,-1]}}"
@@ -26,11 +28,41 @@ _message_next_arg()
             _files
         fi
     fi
-}}
+}}'''
+
+# the sections are streamed between the start and the end of the file
+FILE_START_TEMPLATE = '''#compdef {0}
+
 {1}
+'''
+
+FILE_END_TEMPLATE = '''
 
 _{0} "$@"'''
 
+FILE_TEMPLATE = FILE_START_TEMPLATE + "{2}" + FILE_END_TEMPLATE
+
+# In autoload mode, the sections of every top-level subcommand are written to a separate function file (named after
+# the subcommand's function) next to the completion file, and the helper is written once to a file shared by all
+# the commands. The completion file marks them for autoloading, so zsh only reads them when they are first called.
+# Every function file defines its function and calls it, so it works both when loaded as the function body and
+# when compiled with zcompile.
+AUTOLOAD_FILE_TEMPLATE = '''#compdef {0}
+
+autoload -Uz {1}
+{2}
+
+_{0} "$@"'''
+
+AUTOLOAD_FUNCTION_FILE_END_TEMPLATE = '''
+
+{0} "$@"'''
+
+AUTOLOAD_FUNCTION_FILE_TEMPLATE = "{1}" + AUTOLOAD_FUNCTION_FILE_END_TEMPLATE
+
+MESSAGE_NEXT_ARG = "_message_next_arg"
+SHARED_MESSAGE_NEXT_ARG = "_docopt_message_next_arg"
+
 # this is a template of a function called by the completion system when crawling the arguments already
 # typed. there is a section for every command and sub-command that the target script supports.
 # the variables in the function, "state" and "line" are filled by the _arguments call.
@@ -60,7 +92,7 @@ SUBCOMMAND_SWITCH_TEMPLATE = """'*::options:->options'
             subcommands=(
 {subcommand_list}
             )
-            _values '{subcommand}' $subcommands
+            _values {subcommand} $subcommands
         ;;
 
         (options)
@@ -75,6 +107,26 @@ CASE_TEMPLATE = """                {0})
                     _{1}-{0}
                 ;;"""
 
+# In shared fragments mode, subcommands whose sections would be identical (apart from their names) share the section
+# of the first one, and a single case calls the shared function for all of them. Since the section lists the
+# subcommands under the title of its path, the title is passed to the shared function. Option lists used by several
+# sections are defined once, in an array.
+SHARED_CASE_TEMPLATE = """                {0})
+                    _{1} "{2} $line[1]"
+                ;;"""
+
+SHARED_TITLE_TEMPLATE = '"${{1:-{0}}}"'
+
+SHARED_OPTS_TEMPLATE = """
+{0}=(
+\t\t{1}
+)
+"""
+
+SHARED_OPTS_REFERENCE = "\n\t\t${0} \\"
+
+MIN_SHARED_OPTS_LENGTH = 32
+
 # When there are positional arguments to the handled context, we use this tempalte.
 # We output the name of the next positional argument by using the _message_next_args
 # function (defined in FILE_TEMPLATE), unless the current word starts with "-" which means
@@ -92,7 +144,7 @@ _{cmd_name} ()
 
     else
         myargs=({args})
-        _message_next_arg
+        {message_next_arg}
     fi
 }}
 """
@@ -100,6 +152,14 @@ _{cmd_name} ()
 class ZshCompletion(CompletionGenerator):
     """ Base class for generating ZSH completion files"""
 
+    def __init__(self, autoload=False, zcompile=False, share_fragments=False):
+        # autoload: write every top-level subcommand to a separate autoloaded function file
+        # zcompile: compile the written files with zcompile, so zsh loads them without parsing
+        # share_fragments: emit identical sections and option lists once
+        self.autoload = autoload
+        self.zcompile = zcompile
+        self.share_fragments = share_fragments
+
     # The completion paths defined here (the base class) are used if manual file generation is specified.
     # the paths are redefined in subclasses for automatic generation
 
@@ -112,6 +172,9 @@ class ZshCompletion(CompletionGenerator):
     def create_opt_menu(self, opts, option_help):
         if not opts:
             return ""
+        return '\n' + '\n'.join(["\t\t{0} \\".format(opt_spec) for opt_spec in self.get_opt_specs(opts, option_help)])
+
+    def get_opt_specs(self, opts, option_help):
         # this menu is added to the _arguments call and describes the options
         show_help = all(opt in option_help for opt in opts)  # show help only if all options have help
         def get_option_help(opt):
@@ -122,80 +185,209 @@ class ZshCompletion(CompletionGenerator):
             # add "-" to opts that end with "="
             # '=-' to _arguments means that "=" is appended to the option upon completion
             return (opt + "-") if opt.endswith("=") else opt
-        return '\n' + '\n'.join(["\t\t'({0}){0}{1}' \\".format(decorate_opt(opt), get_option_help(opt))
-                                 for opt in opts])
+        return ["'({0}){0}{1}'".format(decorate_opt(opt), get_option_help(opt)) for opt in opts]
 
-    def create_subcommand_cases(self, cmd_name, subcmds):
+    def create_subcommand_cases(self, cmd_name, subcmds, functions=None, title=None):
         # the subcommand menu is added to the switch-case of line[1], which tests the next subcommand.
-        # the switch-case directs the next sub-command to its relevant section (function)
+        # the switch-case directs the next sub-command to its relevant section (function).
+        # functions maps the subcommands to the names of their functions, if they aren't the default ones
+        if functions is not None:
+            return '\n'.join([SHARED_CASE_TEMPLATE.format("|".join(group), function, title[1:-1])
+                              for function, group in group_by_function(subcmds, functions)])
         return '\n'.join([CASE_TEMPLATE.format(cmd, cmd_name) for cmd in subcmds])
 
-    def create_subcommand_list(self, cmd_name, option_help, subcmds):
+    def create_subcommand_list(self, cmd_name, option_help, subcmds, path=None):
+        # path is the tuple of subcommand names leading to this section. if it isn't given, it's extracted from
+        # cmd_name, which works as long as the command name has no "-"
+        help_index = HelpIndex.from_option_help(option_help)
+        if path is None:
+            path = tuple(cmd_name.split("-")[1:])
         def get_subcmd_help(subcmd):
-            # help for subcommands contains the trail, with or without the script name. extract that from cmd_name
-            for i in [0, 1]:
-                subcommand_with_trail = ' '.join(cmd_name.replace("-", " ").split()[i:] + [subcmd])
-                if subcommand_with_trail in option_help:
-                    return option_help[subcommand_with_trail]
-            return None
+            return help_index.get_subcommand_help(path + (subcmd,))
         # show help only if all subcommands have help
         show_help = all(get_subcmd_help(subcmd) is not None for subcmd in subcmds)
         def get_help_opt(subcmd):
             if not show_help:
                 return ''
-            return "[{0}]".format(get_subcmd_help(subcmd))
+            return "[{0}]".format(escape_zsh_description(get_subcmd_help(subcmd)))
         # the subcommand list is filled into the "subcommands" variable which is sent to the _values command,
         # to specify the next completion options. It includes all the next available sub-commands
         return '\n'.join(["\t\t\t\t'{0}{1}'".format(subcmd, get_help_opt(subcmd)) for subcmd in subcmds])
 
-    def create_subcommand_switch(self, cmd_name, option_help, subcommands):
+    def create_subcommand_switch(self, cmd_name, option_help, subcommands, path=None, functions=None, title=None):
+        # title is the quoted title of the subcommand list, which is the path of the section by default
         if len(subcommands) == 0:
             return ""
-        subcommand_list = self.create_subcommand_list(cmd_name, option_help, subcommands.keys())
-        subcommand_cases = self.create_subcommand_cases(cmd_name, subcommands.keys())
+        if title is None:
+            title = "'{0}'".format(cmd_name.replace('-', ' '))
+        subcommand_list = self.create_subcommand_list(cmd_name, option_help, subcommands.keys(), path)
+        subcommand_cases = self.create_subcommand_cases(cmd_name, subcommands.keys(), functions, title)
         return SUBCOMMAND_SWITCH_TEMPLATE.format(subcommand_list=subcommand_list,
                                                  subcommand_cases=subcommand_cases,
-                                                 subcommand=cmd_name.replace('-', ' '))
+                                                 subcommand=title)
+
+    def get_message_next_arg_name(self):
+        return SHARED_MESSAGE_NEXT_ARG if self.autoload else MESSAGE_NEXT_ARG
+
+    def get_message_next_arg_definition(self):
+        return MESSAGE_NEXT_ARG_TEMPLATE.format(self.get_message_next_arg_name())
 
     def create_args_section(self, cmd_name, opt_list, args):
         res = ARG_SECTION_TEMPLATE.format(cmd_name="{}".format(cmd_name),
                                            args=' '.join("'{}'".format(arg) for arg in args),
-                                           opt_list=opt_list)
+                                           opt_list=opt_list,
+                                           message_next_arg=self.get_message_next_arg_name())
         return res
 
-    def create_section(self, cmd_name, param_tree, option_help):
-        subcommands = param_tree.subcommands
+    def create_single_section(self, cmd_name, param_tree, option_help, path=None, functions=None, opt_list=None,
+                              title=None):
+        # functions and title are passed to create_subcommand_switch, and opt_list replaces the option menu
         opts = param_tree.options
         args = param_tree.arguments
-        opt_list = self.create_opt_menu(opts, option_help)
+        if opt_list is None:
+            opt_list = self.create_opt_menu(opts, option_help)
         if args:
             # when we have an argument we move the completion system to arguments-or-options only section,
             # this means we DON'T support a script that has a arguments-or-subcommands part like:
             # script-name.py (<some-arg> | (a-subcommand <command-arg>))
             return self.create_args_section(cmd_name, opt_list, args)
-        subcommand_switch = self.create_subcommand_switch(cmd_name, option_help, subcommands)
-        res = SECTION_TEMPLATE.format(cmd_name=cmd_name,
-                                      opt_list=opt_list,
-                                      subcommand_switch=subcommand_switch)
-        for subcommand_name, subcommand_tree in subcommands.items():
-            res += self.create_section("{0}-{1}".format(cmd_name, subcommand_name), subcommand_tree, option_help)
-        return res
+        subcommand_switch = self.create_subcommand_switch(cmd_name, option_help, param_tree.subcommands, path,
+                                                          functions, title)
+        return SECTION_TEMPLATE.format(cmd_name=cmd_name,
+                                       opt_list=opt_list,
+                                       subcommand_switch=subcommand_switch)
+
+    def _get_section_subcommands(self, param_tree):
+        # the subcommands of a section with arguments are not completed, so they get no sections
+        return {} if param_tree.arguments else param_tree.subcommands
+
+    def iter_sections(self, cmd_name, param_tree, option_help, path=()):
+        # path is the tuple of subcommand names leading to param_tree, whose section is named cmd_name
+        if self.share_fragments:
+            for chunk in self._iter_shared_sections(cmd_name, param_tree, option_help, path):
+                yield chunk
+            return
+        for subcommand_path, subcommand_tree in param_tree.walk(get_subcommands=self._get_section_subcommands):
+            yield self.create_single_section("-".join((cmd_name,) + subcommand_path), subcommand_tree,
+                                             option_help, path + subcommand_path)
+
+    def _get_section_key(self, path, param_tree, child_keys, help_index):
+        # everything that the section of param_tree renders, apart from its name and title
+        subcommands = self._get_section_subcommands(param_tree)
+        key = (tuple(param_tree.options), tuple(param_tree.arguments), tuple(subcommands), child_keys)
+        if subcommands:
+            key += (tuple(help_index.get_subcommand_help(path + (subcommand,)) for subcommand in subcommands),)
+        return key
+
+    def find_shared_subtrees(self, param_tree, option_help, path=()):
+        help_index = HelpIndex.from_option_help(option_help)
+        return SharedSubtrees(param_tree, lambda node_path, node, child_keys:
+                              self._get_section_key(node_path, node, child_keys, help_index),
+                              path, self._get_section_subcommands)
+
+    def _iter_shared_sections(self, cmd_name, param_tree, option_help, path):
+        shared = self.find_shared_subtrees(param_tree, option_help, path)
+        def get_function(subcommand_path):
+            return "-".join((cmd_name,) + shared.get_canonical_path(subcommand_path)[len(path):])
+        def get_opt_specs(node):
+            return "\n\t\t".join(self.get_opt_specs(node.options, option_help))
+        opt_lists = SharedFragments((get_opt_specs(node) for _, node in shared.iter_canonical()),
+                                    "_" + re.sub("[^A-Za-z0-9_]", "_", cmd_name) + "_opts_{0}", MIN_SHARED_OPTS_LENGTH)
+        for variable, opt_specs in opt_lists.definitions:
+            yield SHARED_OPTS_TEMPLATE.format(variable, opt_specs)
+        for subcommand_path, subcommand_tree in shared.iter_canonical():
+            section_name = get_function(subcommand_path)
+            subcommands = self._get_section_subcommands(subcommand_tree)
+            functions = dict((subcommand_name, get_function(subcommand_path + (subcommand_name,)))
+                             for subcommand_name in subcommands)
+            variable = opt_lists.get_name(get_opt_specs(subcommand_tree))
+            opt_list = SHARED_OPTS_REFERENCE.format(variable) if variable is not None else None
+            # the section at the top of the file isn't shared, so it gets no title from its caller
+            title = "'{0}'".format(section_name.replace('-', ' '))
+            if subcommand_path != path:
+                title = SHARED_TITLE_TEMPLATE.format(section_name.replace('-', ' '))
+            yield self.create_single_section(section_name, subcommand_tree, option_help, subcommand_path, functions,
+                                             opt_list, title)
+
+    def create_section(self, cmd_name, param_tree, option_help):
+        return "".join(self.iter_sections(cmd_name, param_tree, option_help))
+
+    def _get_autoload_functions(self, cmd, param_tree):
+        return ["_{0}-{1}".format(cmd, subcommand_name)
+                for subcommand_name in self._get_section_subcommands(param_tree)]
+
+    def iter_completion_file_content(self, cmd, param_tree, option_help):
+        option_help = HelpIndex.from_option_help(option_help)
+        if self.autoload:
+            functions = [self.get_message_next_arg_name()] + self._get_autoload_functions(cmd, param_tree)
+            yield AUTOLOAD_FILE_TEMPLATE.format(cmd, " ".join(functions),
+                                                self.create_single_section(cmd, param_tree, option_help, ()))
+            return
+        yield FILE_START_TEMPLATE.format(cmd, self.get_message_next_arg_definition())
+        for chunk in self.iter_sections(cmd, param_tree, option_help):
+            yield chunk
+        yield FILE_END_TEMPLATE.format(cmd)
 
     def get_completion_file_content(self, cmd, param_tree, option_help):
-        completion_file_inner_content = self.create_section(cmd, param_tree, option_help)
-        return FILE_TEMPLATE.format(cmd, completion_file_inner_content)
+        return "".join(self.iter_completion_file_content(cmd, param_tree, option_help))
+
+    def _iter_function_file(self, function_name, param_tree, option_help, path):
+        for chunk in self.iter_sections(function_name[1:], param_tree, option_help, path):
+            yield chunk
+        yield AUTOLOAD_FUNCTION_FILE_END_TEMPLATE.format(function_name)
+
+    def iter_auxiliary_files(self, cmd, param_tree, option_help):
+        if not self.autoload:
+            return
+        option_help = HelpIndex.from_option_help(option_help)
+        message_next_arg = self.get_message_next_arg_name()
+        yield message_next_arg, [AUTOLOAD_FUNCTION_FILE_TEMPLATE.format(message_next_arg,
+                                                                        self.get_message_next_arg_definition())]
+        subcommands = self._get_section_subcommands(param_tree)
+        for function_name, subcommand_name in zip(self._get_autoload_functions(cmd, param_tree), subcommands):
+            yield function_name, self._iter_function_file(function_name, subcommands[subcommand_name], option_help,
+                                                          (subcommand_name,))
+
+    def get_auxiliary_files(self, cmd, param_tree, option_help):
+        return [(relative_path, "".join(chunks))
+                for relative_path, chunks in self.iter_auxiliary_files(cmd, param_tree, option_help)]
+
+    def _zcompile(self, file_paths):
+        # compile only the files whose .zwc is missing or older than the file
+        file_paths = [file_path for file_path in file_paths
+                      if not os.path.exists(file_path + ".zwc") or
+                      os.path.getmtime(file_path + ".zwc") < os.path.getmtime(file_path)]
+        if not file_paths:
+            return
+        try:
+            with phase("zcompile", files=len(file_paths)):
+                returncode = subprocess.call(["zsh", "-fc", 'for file; do zcompile -Uz -- "$file" || exit 1; done',
+                                              "zcompile"] + file_paths)
+        except OSError:
+            print("Skipping zcompile, zsh was not found")
+            return
+        if returncode != 0:
+            print("zcompile failed for some of the files in {0}".format(", ".join(file_paths)))
+            return
+        for file_path in file_paths:
+            print("Compiled {0}.zwc".format(file_path))
+
+    def generate(self, cmd, param_tree, option_help, report=None):
+        results = super(ZshCompletion, self).generate(cmd, param_tree, option_help, report)
+        if self.zcompile:
+            self._zcompile([file_path for file_path, status in results if status != SKIPPED])
+        return results
 
 class OhMyZshCompletion(ZshCompletion):
     def get_name(self):
         return "ZSH with oh-my-zsh"
 
     def get_completion_path(self):
-        return os.path.expanduser('~/.oh-my-zsh')
+        return self.get_completion_dirs().get_oh_my_zsh_dir()
 
     def get_completion_filepath(self, cmd):
-        completion_path = os.path.expanduser('~/.oh-my-zsh/completions')
-        if not os.path.exists(completion_path):
-            os.makedirs(completion_path)
+        # the completions directory is created when the file is written
+        completion_path = os.path.join(self.get_completion_path(), "completions")
         return os.path.join(completion_path, "_{0}".format(cmd))
 
 class ZshPreztoCompletion(ZshCompletion):
@@ -203,10 +395,10 @@ class ZshPreztoCompletion(ZshCompletion):
         return "ZSH with Prezto"
 
     def get_completion_path(self):
-        return os.path.expanduser('~/.zprezto')
+        return self.get_completion_dirs().get_prezto_dir()
 
     def get_completion_filepath(self, cmd):
-        completion_path = os.path.expanduser("~/.zprezto/modules/completion/external/src")
+        completion_path = os.path.join(self.get_completion_path(), "modules", "completion", "external", "src")
         return os.path.join(completion_path, "_{0}".format(cmd))
 
 class ZshUsrShareCompletion(ZshCompletion):
@@ -217,30 +409,10 @@ class ZshUsrShareCompletion(ZshCompletion):
         return "/usr/share/zsh/*/functions"
 
     def _get_completion_paths(self):
-        prefixes = [
-            os.path.join(os.path.sep, "usr"),
-            os.path.join(os.path.sep, "usr", "local"),
-            os.path.join(os.path.sep, "opt", "freeware"),
-            os.path.join(os.path.sep, "opt", "csw")
-        ]
-        infixes = [
-            "site",
-            "vendor"
-        ]
-        suffixes = [
-            "completions",
-            "functions"
-        ]
-        for prefix in prefixes:
-            for infix in infixes:
-                for suffix in suffixes:
-                    path = os.path.join(prefix, "share", "zsh",
-                                        "{}-{}".format(infix, suffix))
-                    if os.path.isdir(path):
-                        yield path
+        return self.get_completion_dirs().get_zsh_site_dirs()
 
     def completion_path_exists(self):
-        return any(os.path.exists(path) for path in self._get_completion_paths())
+        return len(self._get_completion_paths()) > 0
 
     def get_completion_filepath(self, cmd):
         for completion_path in self._get_completion_paths():
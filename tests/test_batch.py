@@ -0,0 +1,50 @@
+import unittest
+from infi.docopt_completion.common import DocoptCompletionException
+from infi.docopt_completion.docopt_completion import docopt_completion_batch
+
+USAGES = {"naval": "Usage: naval ship <name> [--speed=<kn>]\n",
+          "empty": "Usage:\n",
+          "invalid": "Usage: invalid (ship\n"}
+
+
+class FakeCapturer(object):
+    def get_usage(self, cmd):
+        if cmd == "missing":
+            raise DocoptCompletionException("Failed to run 'missing --help' : command does not exist")
+        if cmd == "broken":
+            raise RuntimeError("unexpected")
+        return USAGES[cmd]
+
+
+class FakeGenerator(object):
+    def __init__(self, fail_for=()):
+        self.generated = []
+        self.fail_for = fail_for
+
+    def generate(self, cmd, param_tree, option_help, report=None):
+        if cmd in self.fail_for:
+            raise IOError("disk full")
+        self.generated.append(cmd)
+
+
+class BatchTestCase(unittest.TestCase):
+    def run_batch(self, cmds, generator):
+        return dict(docopt_completion_batch(cmds, jobs=2, use_cache=False, capturer=FakeCapturer(),
+                                            generators=[generator]))
+
+    def test_failures_are_reported_per_script(self):
+        generator = FakeGenerator()
+        results = self.run_batch(["naval", "missing", "broken", "empty", "invalid"], generator)
+        self.assertEqual(generator.generated, ["naval", "empty"])
+        self.assertIsNone(results["naval"])
+        self.assertIsNone(results["empty"])
+        self.assertIn("command does not exist", results["missing"])
+        self.assertIn("unexpected", results["broken"])
+        self.assertIn("Failed to parse the usage", results["invalid"])
+
+    def test_generation_failures_are_reported_per_script(self):
+        generator = FakeGenerator(fail_for=["naval"])
+        results = self.run_batch(["naval", "empty"], generator)
+        self.assertEqual(generator.generated, ["empty"])
+        self.assertIn("disk full", results["naval"])
+        self.assertIsNone(results["empty"])
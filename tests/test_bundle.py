@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+import docopt
+from infi.docopt_completion.bundle import get_manifest_path
+from infi.docopt_completion.docopt_completion import USAGE, _run
+
+SCRIPT = '''#!/usr/bin/env python
+"""Usage: naval ship <name> [--speed=<kn>]"""
+from docopt import docopt
+'''
+
+
+class BundleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.script = os.path.join(self.temp_dir, "naval")
+        with open(self.script, "w") as fd:
+            fd.write(SCRIPT)
+        os.chmod(self.script, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_bundle(self, bundle_path, cmds):
+        # the usage is read from the script, so it isn't run
+        arguments = docopt.docopt(USAGE, ["--static", "--no-cache", "--bundle=" + bundle_path] + cmds)
+        return _run(arguments)
+
+    def test_bundle(self):
+        for name in ("stage", "bundle.tar.gz", "bundle.zip"):
+            bundle_path = os.path.join(self.temp_dir, name)
+            self.assertEqual(self.run_bundle(bundle_path, [self.script]), 0)
+            self.assertTrue(os.path.exists(bundle_path))
+            self.assertTrue(os.path.exists(get_manifest_path(bundle_path)))
+        self.assertTrue(os.path.isfile(os.path.join(self.temp_dir, "stage", "usr", "share", "bash-completion",
+                                                    "completions", "naval")))
+
+    def test_partial_failure_discards_the_bundle(self):
+        missing = os.path.join(self.temp_dir, "missing")
+        for name in ("stage", "bundle.tar.gz", "bundle.zip"):
+            bundle_path = os.path.join(self.temp_dir, name)
+            self.assertEqual(self.run_bundle(bundle_path, [self.script, missing]), 1)
+            self.assertFalse(os.path.exists(bundle_path))
+            self.assertFalse(os.path.exists(get_manifest_path(bundle_path)))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ["naval"])
+
+    def test_partial_failure_empties_an_existing_staging_directory(self):
+        bundle_path = os.path.join(self.temp_dir, "stage")
+        os.mkdir(bundle_path)
+        self.assertEqual(self.run_bundle(bundle_path, [self.script, os.path.join(self.temp_dir, "missing")]), 1)
+        self.assertEqual(os.listdir(bundle_path), [])
+        self.assertFalse(os.path.exists(get_manifest_path(bundle_path)))
@@ -0,0 +1,99 @@
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from infi.docopt_completion.bash import BashCompletion
+from infi.docopt_completion.common import parse_usage
+from infi.docopt_completion.daemon import CompletionDaemon, StaticValueProvider, ValueResolver, query
+
+USAGE = """Usage:
+    naval ship new <name>...
+    naval mine set <x> <y> [--moored]
+"""
+
+# stands in for socat, which the completion files use to talk to the daemon
+FAKE_SOCAT = """#!{python}
+import socket, sys
+client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+client.connect(sys.argv[-1].split(":", 1)[1])
+client.sendall(sys.stdin.readline().encode("utf-8"))
+while True:
+    chunk = client.recv(4096)
+    if not chunk:
+        break
+    sys.stdout.write(chunk.decode("utf-8"))
+"""
+
+
+def find_bash():
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, "bash")
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class DaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tempdir, "daemon.sock")
+        providers = [StaticValueProvider(["enterprise", "endeavour", "voyager"], command="naval", argument="<name>"),
+                     StaticValueProvider(["1", "2"], command="naval", path=["mine", "set"], argument="<x>")]
+        self.daemon = CompletionDaemon(ValueResolver(providers), self.socket_path)
+        self.daemon.start()
+        self.thread = threading.Thread(target=self.daemon.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.stop_daemon()
+        shutil.rmtree(self.tempdir)
+
+    def stop_daemon(self):
+        if self.daemon.server is not None:
+            self.daemon.server.shutdown()
+            self.daemon.stop()
+
+    def test_query(self):
+        self.assertEqual(query("naval", ("ship",), "<name>", "en", self.socket_path), ["enterprise", "endeavour"])
+        self.assertEqual(query("naval", ("mine", "set"), "<x>", "", self.socket_path), ["1", "2"])
+        self.assertEqual(query("naval", ("mine", "set"), "<y>", "", self.socket_path), [])
+
+    def test_query_without_daemon(self):
+        self.assertIsNone(query("naval", ("ship",), "<name>", "", os.path.join(self.tempdir, "missing.sock")))
+
+    def complete(self, words):
+        bash = find_bash()
+        if bash is None:
+            raise unittest.SkipTest("bash is not installed")
+        param_tree, option_help = parse_usage(USAGE)
+        completion_path = os.path.join(self.tempdir, "naval")
+        with open(completion_path, "w") as fd:
+            fd.write(BashCompletion(dynamic_values=True).get_completion_file_content("naval", param_tree, option_help))
+        bin_dir = os.path.join(self.tempdir, "bin")
+        if not os.path.isdir(bin_dir):
+            os.mkdir(bin_dir)
+        socat_path = os.path.join(bin_dir, "socat")
+        with open(socat_path, "w") as fd:
+            fd.write(FAKE_SOCAT.format(python=sys.executable))
+        os.chmod(socat_path, stat.S_IRWXU)
+        script = ('. "$1"; shift; COMP_WORDS=("$@"); COMP_CWORD=$(( $# - 1 )); COMPREPLY=(); _naval; '
+                  'printf "%s\\n" "${COMPREPLY[@]}"')
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+                   DOCOPT_COMPLETION_SOCKET=self.socket_path)
+        output = subprocess.check_output([bash, "-c", script, "bash", completion_path] + words, env=env)
+        return output.decode("utf-8").split()
+
+    def test_bash_completes_values_from_the_daemon(self):
+        self.assertEqual(self.complete(["naval", "ship", "new", "en"]), ["enterprise", "endeavour"])
+        # the values are added to the options and file names
+        self.assertTrue(set(["1", "2", "--moored"]) <= set(self.complete(["naval", "mine", "set", ""])))
+        self.assertNotIn("1", self.complete(["naval", "mine", "set", "1", ""]))
+
+    def test_bash_falls_back_without_daemon(self):
+        self.stop_daemon()
+        self.assertEqual(self.complete(["naval", "ship", "new", "en"]), [])
@@ -0,0 +1,11 @@
+import sys
+import unittest
+from infi.docopt_completion.benchmark import check_import_time
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    @unittest.skipIf(sys.version_info < (3, 7), "python -X importtime requires python 3.7")
+    def test_lazy_imports(self):
+        # fails if importing the entry point imports pkg_resources or any of the modules that are imported only when
+        # they are used. the import time isn't checked, since it depends on the load of the machine
+        self.assertEqual(check_import_time(budget=None), [])
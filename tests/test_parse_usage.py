@@ -0,0 +1,19 @@
+import unittest
+from infi.docopt_completion.common import CommandParams, PARSERS, parse_usage
+
+
+class ParseUsageTestCase(unittest.TestCase):
+    def test_usage_without_program_name(self):
+        # a help text that is just "Usage:" has no usage patterns, and no program name to index the help by
+        for parser in PARSERS:
+            for usage in ("Usage:", "Usage:\n"):
+                param_tree, option_help = parse_usage(usage, parser=parser)
+                self.assertEqual(param_tree, CommandParams())
+                self.assertIsNone(option_help.program_name)
+                self.assertEqual(dict(option_help), {})
+
+    def test_program_name(self):
+        for parser in PARSERS:
+            param_tree, option_help = parse_usage("Usage: prog go [-v]\n", parser=parser)
+            self.assertEqual(option_help.program_name, "prog")
+            self.assertEqual(list(param_tree.subcommands), ["go"])
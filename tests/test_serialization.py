@@ -0,0 +1,113 @@
+import json
+import unittest
+from infi.docopt_completion.common import (CommandParams, HelpIndex, SharedSubtrees, DocoptCompletionException,
+                                           SERIALIZATION_FORMAT_VERSION, parse_usage, dump_params, load_params)
+
+USAGE = """Naval Fate.
+
+Usage:
+  naval_fate ship new <name>... [-h | --help]
+  naval_fate ship <name> move <x> <y> [--speed=<kn>] [-h | --help]
+  naval_fate ship shoot <x> <y> [-h | --help]
+  naval_fate mine (set|remove) <x> <y> [--moored|--drifting]
+  naval_fate fleet (set|remove) <x> <y> [--moored|--drifting]
+  naval_fate -h | --help
+  naval_fate --version
+
+Options:
+  -h --help     Show this screen.
+  --version     Show version.
+  --speed=<kn>  Speed in knots [default: 10].
+  --moored      Moored (anchored) mine.
+  --drifting    Drifting mine.
+
+Commands:
+  ship          Manage ships.
+  mine          Manage mines.
+"""
+
+
+class SerializationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.param_tree, self.option_help = parse_usage(USAGE)
+
+    def assert_round_trip(self, param_tree, option_help):
+        loaded_tree, loaded_help = load_params(dump_params(param_tree, option_help))
+        self.assertEqual(loaded_tree, param_tree)
+        self.assertEqual([path for path, _ in loaded_tree.walk()], [path for path, _ in param_tree.walk()])
+        self.assertIsInstance(loaded_help, HelpIndex)
+        self.assertEqual(dict(loaded_help), dict(option_help))
+        self.assertEqual(loaded_help.program_name, option_help.program_name)
+        self.assertEqual(loaded_help.options, option_help.options)
+        self.assertEqual(loaded_help.subcommands, option_help.subcommands)
+        return loaded_tree, loaded_help
+
+    def test_round_trip(self):
+        self.assert_round_trip(self.param_tree, self.option_help)
+
+    def test_round_trip_empty(self):
+        self.assert_round_trip(CommandParams(), HelpIndex())
+
+    def test_round_trip_help_index(self):
+        _, loaded_help = self.assert_round_trip(self.param_tree, self.option_help)
+        self.assertEqual(loaded_help.get_option_help("--speed="), "Speed in knots [default: 10].")
+        self.assertEqual(loaded_help.get_subcommand_help(("ship",)), "Manage ships.")
+        self.assertEqual(loaded_help["--moored"], self.option_help["--moored"])
+
+    def test_round_trip_option_help_dict(self):
+        # parse_params used to return a plain dict of escaped descriptions
+        option_help = dict(self.option_help)
+        _, loaded_help = load_params(dump_params(self.param_tree, option_help))
+        self.assertEqual(dict(loaded_help), option_help)
+
+    def test_dump_is_stable(self):
+        serialized = dump_params(self.param_tree, self.option_help)
+        self.assertEqual(dump_params(*load_params(serialized)), serialized)
+
+    def test_subcommand_order(self):
+        loaded_tree, _ = self.assert_round_trip(self.param_tree, self.option_help)
+        self.assertEqual(list(loaded_tree.subcommands), ["ship", "mine", "fleet"])
+        self.assertEqual(list(loaded_tree.subcommands["ship"].subcommands), ["new", "move", "shoot"])
+
+    def test_options_deduplicated(self):
+        # the options of every usage line are added to the tree, but each is stored once, in the order it first appeared
+        param_tree, option_help = parse_usage("Usage:\n  prog go [-v] [--fast]\n  prog go [--fast] [-q] <x>\n"
+                                              "  prog go [-v] <x> <y>\n")
+        go = param_tree.subcommands["go"]
+        self.assertEqual(list(go.options), ["-v", "--fast", "-q"])
+        self.assertEqual(list(go.arguments), ["<x>", "<y>"])
+        loaded_tree, _ = self.assert_round_trip(param_tree, option_help)
+        self.assertEqual(list(loaded_tree.subcommands["go"].options), ["-v", "--fast", "-q"])
+
+    def test_shared_subtrees(self):
+        def get_key(path, node, child_keys):
+            return tuple(node.options), tuple(node.arguments), tuple(node.subcommands), child_keys
+        loaded_tree, _ = self.assert_round_trip(self.param_tree, self.option_help)
+        for param_tree in (self.param_tree, loaded_tree):
+            shared = SharedSubtrees(param_tree, get_key)
+            self.assertEqual(shared.get_canonical_path(("fleet",)), ("mine",))
+            # "set" and "remove" complete the same way, under both "mine" and "fleet"
+            self.assertEqual(shared.get_canonical_path(("fleet", "remove")), ("mine", "set"))
+            self.assertEqual(shared.get_canonical_path(("mine", "remove")), ("mine", "set"))
+            self.assertFalse(shared.is_canonical(("fleet", "set")))
+            self.assertTrue(shared.is_canonical(("ship", "move")))
+        self.assertEqual([path for path, _ in SharedSubtrees(loaded_tree, get_key).iter_canonical()],
+                         [path for path, _ in SharedSubtrees(self.param_tree, get_key).iter_canonical()])
+
+    def test_names_interned(self):
+        loaded_tree, _ = load_params(dump_params(self.param_tree, self.option_help))
+        mine, fleet = loaded_tree.subcommands["mine"], loaded_tree.subcommands["fleet"]
+        self.assertIs(list(mine.subcommands)[0], list(fleet.subcommands)[0])
+        self.assertIs(mine.options[0], fleet.options[0])
+        self.assertIs(mine.arguments[0], fleet.arguments[0])
+
+    def test_wrong_version(self):
+        data = json.loads(dump_params(self.param_tree, self.option_help))
+        self.assertEqual(data["version"], SERIALIZATION_FORMAT_VERSION)
+        for version in (SERIALIZATION_FORMAT_VERSION - 1, SERIALIZATION_FORMAT_VERSION + 1, None):
+            data["version"] = version
+            with self.assertRaises(DocoptCompletionException):
+                load_params(json.dumps(data))
+        del data["version"]
+        with self.assertRaises(DocoptCompletionException):
+            load_params(json.dumps(data))